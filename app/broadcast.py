@@ -0,0 +1,367 @@
+# app/broadcast.py
+"""Массовые рассылки: параллельная отправка под лимитами Telegram.
+
+Username → chat_id берутся из справочника (directory.py), за ненайденными —
+одно чтение addresses; сообщения уходят параллельно через общий SendLimiter
+(RetryAfter ставит на паузу всю рассылку), а подписки получателей пишутся
+в лист одной записью.
+
+Рассылка всем должникам идёт фоновой задачей JobQueue: план и курсор
+сохраняются на диск после каждой пачки, поэтому после рестарта она
+продолжается с места остановки (пачка, прерванная рестартом, может уйти
+повторно). Прогресс — одно сообщение админу, которое периодически
+редактируется; кнопки «Остановить»/«Продолжить» управляют задачей.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import RetryAfter
+from telegram.ext import Application, ContextTypes
+
+from . import directory
+from . import sheets_async as asheets
+from .config import (
+    BROADCAST_RATE,
+    BROADCAST_CHAT_RATE,
+    BROADCAST_CONCURRENCY,
+    BROADCAST_STATE_PATH,
+    BROADCAST_PROGRESS_SECONDS,
+)
+from .ratelimit import SendLimiter
+from .texts import UNPAID_REMINDER
+
+logger = logging.getLogger(__name__)
+
+NO_CHAT_ID = "нет chat_id"
+_RETRIES = 3
+
+# Один лимитер на процесс: все рассылки делят лимит бота.
+LIMITER = SendLimiter(BROADCAST_RATE, BROADCAST_CHAT_RATE)
+
+
+def err_reason(e: Exception | str) -> str:
+    """Короткая причина ошибки отправки."""
+    if isinstance(e, str):
+        return e
+    s = str(e).lower()
+    if "forbidden" in s or "blocked" in s:
+        return "бот заблокирован"
+    if "chat not found" in s or "not found" in s:
+        return NO_CHAT_ID
+    if "bad request" in s:
+        return "bad request"
+    if "retry after" in s or "flood" in s:
+        return "rate limit"
+    if "timeout" in s:
+        return "timeout"
+    return "ошибка"
+
+
+async def send(bot, chat_id: int, text: str, chat_ready: bool = False, **kwargs) -> Optional[Exception]:
+    """Отправить сообщение с учётом лимитов. None — доставлено, иначе ошибка.
+
+    chat_ready=True — токен лимита чата уже получен вызывающим.
+    """
+    error: Optional[Exception] = None
+    for attempt in range(_RETRIES):
+        if attempt or not chat_ready:
+            await LIMITER.wait_chat(chat_id)
+        await LIMITER.wait_global()
+        try:
+            await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+            return None
+        except RetryAfter as e:
+            # flood control действует на весь бот — ждут все отправки
+            LIMITER.pause(float(e.retry_after))
+            error = e
+        except Exception as e:
+            return e
+    return error
+
+
+async def send_many(
+    bot,
+    messages: List[Tuple[int, str]],
+    on_result: Optional[Callable[[int, Optional[Exception]], Any]] = None,
+    **kwargs,
+) -> List[Optional[Exception]]:
+    """Разослать [(chat_id, text), ...] параллельно; ошибки в том же порядке.
+
+    on_result(i, error) вызывается по мере завершения каждой отправки.
+    """
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+    async def one(i: int, chat_id: int, text: str) -> Optional[Exception]:
+        # очередь своего чата ждём до семафора, чтобы не занимать слот
+        await LIMITER.wait_chat(chat_id)
+        async with sem:
+            error = await send(bot, chat_id, text, chat_ready=True, **kwargs)
+        if error is not None:
+            logger.warning("broadcast fail to %s: %s", chat_id, error)
+        if on_result is not None:
+            on_result(i, error)
+        return error
+
+    return list(await asyncio.gather(*(one(i, c, t) for i, (c, t) in enumerate(messages))))
+
+
+async def remind_unpaid(bot, grouped: Dict[str, List[str]]) -> Dict[str, List[Tuple[str, Any]]]:
+    """Напомнить должникам об оплате.
+
+    grouped — {order_id: [username, ...]}. Возвращает {order_id: [(username, ошибка)]},
+    где ошибка — None (доставлено), NO_CHAT_ID или исключение отправки.
+    """
+    plan = await _plan(grouped)
+    report: Dict[str, List[Tuple[str, Any]]] = {order_id: [] for order_id in grouped}
+    for (order_id, uname, _), err in zip(plan, await _send_reminders(bot, plan)):
+        report[order_id].append((uname, err))
+    return report
+
+
+async def _plan(grouped: Dict[str, List[str]]) -> List[Tuple[str, str, Optional[int]]]:
+    """[(order_id, username, chat_id | None)] + подписка всех найденных одной записью."""
+    names = sorted({u for users in grouped.values() for u in users if u})
+    ids = await directory.user_ids_map(names)
+    plan = [
+        (order_id, uname, ids.get((uname or "").lstrip("@").lower()))
+        for order_id, users in grouped.items()
+        for uname in users
+    ]
+    # подписываем на обновления заказа, чтобы дальше человек получал статусы
+    try:
+        await asheets.subscribe_many([(uid, order_id) for order_id, _, uid in plan if uid is not None])
+    except Exception as e:
+        logger.warning("remind_unpaid: subscribe failed: %s", e)
+    return plan
+
+
+async def _send_reminders(bot, plan) -> List[Any]:
+    targets = [(uid, UNPAID_REMINDER.format(order_id=order_id)) for order_id, _, uid in plan if uid is not None]
+    errors = iter(await send_many(bot, targets, parse_mode="Markdown"))
+    return [NO_CHAT_ID if uid is None else next(errors) for _, _, uid in plan]
+
+
+# -------------------------------------------------
+#  Фоновая рассылка всем должникам
+# -------------------------------------------------
+
+_JOB_NAME = "broadcast_unpaid"
+_CHUNK = max(1, BROADCAST_CONCURRENCY)
+
+# Состояние текущей рассылки (оно же лежит в BROADCAST_STATE_PATH):
+# plan — [[order_id, username, chat_id | None]], cursor — сколько обработано,
+# results — причина ошибки по каждому обработанному (None — доставлено),
+# status — running / cancelled / done.
+_STATE: Optional[Dict[str, Any]] = None
+_LOADED = False
+# задача рассылки сейчас выполняется (JobQueue уже снял её с расписания)
+_ACTIVE = False
+
+
+def _load_state() -> Optional[Dict[str, Any]]:
+    global _STATE, _LOADED
+    if not _LOADED:
+        _LOADED = True
+        try:
+            with open(BROADCAST_STATE_PATH, encoding="utf-8") as f:
+                _STATE = json.load(f)
+        except FileNotFoundError:
+            _STATE = None
+        except Exception as e:
+            logger.warning("Broken broadcast state %s: %s", BROADCAST_STATE_PATH, e)
+            _STATE = None
+    return _STATE
+
+
+def _save_state(state: Dict[str, Any]) -> None:
+    global _STATE, _LOADED
+    _STATE, _LOADED = state, True
+    os.makedirs(os.path.dirname(os.path.abspath(BROADCAST_STATE_PATH)), exist_ok=True)
+    tmp = BROADCAST_STATE_PATH + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, BROADCAST_STATE_PATH)
+
+
+def _counts(state: Dict[str, Any]) -> Tuple[int, int]:
+    ok = sum(1 for r in state["results"] if r is None)
+    return ok, len(state["results"]) - ok
+
+
+def _progress_text(state: Dict[str, Any], rate: Optional[float] = None) -> str:
+    ok, fail = _counts(state)
+    total = len(state["plan"])
+    label = {"running": "идёт", "cancelled": "остановлена", "done": "завершена"}[state["status"]]
+    lines = [
+        f"📣 Уведомления всем должникам — {label}",
+        f"✅ Отправлено: {ok}",
+        f"❌ Ошибок: {fail}",
+        f"⏳ Осталось: {total - state['cursor']} из {total}",
+    ]
+    if rate is not None:
+        lines.append(f"⚡ Скорость: {rate:.1f} сообщ./с")
+    return "\n".join(lines)
+
+
+def _progress_kb(state: Dict[str, Any]) -> Optional[InlineKeyboardMarkup]:
+    if state["status"] == "running":
+        return InlineKeyboardMarkup([[InlineKeyboardButton("⏸ Остановить", callback_data="bc:cancel")]])
+    if state["status"] == "cancelled":
+        return InlineKeyboardMarkup([[InlineKeyboardButton("▶️ Продолжить", callback_data="bc:resume")]])
+    return None
+
+
+async def _show_progress(bot, state: Dict[str, Any], rate: Optional[float] = None) -> None:
+    try:
+        await bot.edit_message_text(
+            _progress_text(state, rate),
+            chat_id=state["chat_id"],
+            message_id=state["message_id"],
+            reply_markup=_progress_kb(state),
+        )
+    except Exception as e:
+        # «message is not modified» и удалённое сообщение — не повод падать
+        logger.debug("broadcast progress edit failed: %s", e)
+
+
+def _report(state: Dict[str, Any]) -> str:
+    """Итоговый отчёт: по каждому order_id — пользователи с ✅/❌ и причиной."""
+    by_order: Dict[str, List[str]] = {}
+    totals: Dict[str, List[int]] = {}
+    for (order_id, uname, _), reason in zip(state["plan"], state["results"]):
+        lines = by_order.setdefault(order_id, [f"{order_id}:"])
+        t = totals.setdefault(order_id, [0, 0])
+        if reason is None:
+            t[0] += 1
+            lines.append(f"• ✅ @{uname}")
+        else:
+            t[1] += 1
+            lines.append(f"• ❌ @{uname} — {reason}")
+    blocks = []
+    for order_id, lines in by_order.items():
+        lines.append(f"_Итого по разбору:_ ✅ {totals[order_id][0]}  ❌ {totals[order_id][1]}")
+        blocks.append("\n".join(lines))
+    ok, fail = _counts(state)
+    return "\n".join([
+        "📣 Уведомления всем должникам — итог",
+        f"Разборов: {len(by_order)}",
+        f"✅ Успешно: {ok}",
+        f"❌ Ошибок: {fail}",
+        "",
+        *blocks,
+    ])
+
+
+def _split(text: str, limit: int = 4000) -> List[str]:
+    """Разбить длинный отчёт по строкам под лимит длины сообщения Telegram."""
+    parts, cur = [], ""
+    for line in text.split("\n"):
+        if cur and len(cur) + len(line) + 1 > limit:
+            parts.append(cur)
+            cur = ""
+        cur = f"{cur}\n{line}" if cur else line
+    if cur:
+        parts.append(cur)
+    return parts
+
+
+def _schedule(application: Application) -> None:
+    application.job_queue.run_once(_run, 0, name=_JOB_NAME)
+
+
+def is_busy() -> bool:
+    """Рассылка идёт или ещё дописывает пачку после остановки."""
+    state = _load_state()
+    return _ACTIVE or (bool(state) and state["status"] == "running")
+
+
+async def start_unpaid(application: Application, chat_id: int) -> bool:
+    """Запустить рассылку всем должникам. False — должников нет.
+
+    Вызывающий проверяет is_busy(): одновременно идёт только одна рассылка.
+    """
+    grouped = await asheets.get_all_unpaid_grouped()
+    if not grouped:
+        return False
+    plan = await _plan(grouped)
+    state = {"chat_id": chat_id, "message_id": None, "plan": plan, "cursor": 0, "results": [], "status": "running"}
+    msg = await application.bot.send_message(chat_id, _progress_text(state), reply_markup=_progress_kb(state))
+    state["message_id"] = msg.message_id
+    _save_state(state)
+    _schedule(application)
+    return True
+
+
+async def cancel(bot) -> bool:
+    """Остановить текущую рассылку (задача заметит это после текущей пачки)."""
+    state = _load_state()
+    if not state or state["status"] != "running":
+        return False
+    state["status"] = "cancelled"
+    _save_state(state)
+    await _show_progress(bot, state)
+    return True
+
+
+async def resume(application: Application) -> bool:
+    """Продолжить остановленную (или прерванную рестартом) рассылку с курсора."""
+    state = _load_state()
+    if not state or state["status"] == "done":
+        return False
+    state["status"] = "running"
+    _save_state(state)
+    await _show_progress(application.bot, state)
+    # задача, остановленная посреди пачки, ещё жива — она сама пойдёт дальше
+    if not _ACTIVE and not application.job_queue.get_jobs_by_name(_JOB_NAME):
+        _schedule(application)
+    return True
+
+
+async def resume_on_startup(application: Application) -> None:
+    """Если рестарт застал рассылку в работе — продолжить её."""
+    state = _load_state()
+    if state and state["status"] == "running":
+        logger.info("Resuming unfinished broadcast from item %s", _STATE["cursor"])
+        await resume(application)
+
+
+async def _run(context: ContextTypes.DEFAULT_TYPE) -> None:
+    global _ACTIVE
+    if _ACTIVE:
+        return
+    _ACTIVE = True
+    try:
+        await _broadcast(context.bot)
+    finally:
+        _ACTIVE = False
+
+
+async def _broadcast(bot) -> None:
+    state = _load_state()
+    if not state or state["status"] != "running":
+        return
+    started, start_cursor, shown = time.monotonic(), state["cursor"], time.monotonic()
+    while state["cursor"] < len(state["plan"]):
+        if state["status"] != "running":
+            return  # остановлено кнопкой; прогресс уже показан
+        chunk = state["plan"][state["cursor"]:state["cursor"] + _CHUNK]
+        errors = await _send_reminders(bot, chunk)
+        state["results"].extend(None if e is None else err_reason(e) for e in errors)
+        state["cursor"] += len(chunk)
+        _save_state(state)
+        if time.monotonic() - shown >= BROADCAST_PROGRESS_SECONDS:
+            shown = time.monotonic()
+            await _show_progress(bot, state, (state["cursor"] - start_cursor) / max(shown - started, 1e-6))
+    state["status"] = "done"
+    _save_state(state)
+    elapsed = max(time.monotonic() - started, 1e-6)
+    await _show_progress(bot, state, (state["cursor"] - start_cursor) / elapsed)
+    for part in _split(_report(state)):
+        await bot.send_message(state["chat_id"], part)
@@ -9,3 +9,33 @@ GOOGLE_CREDENTIALS_JSON = os.getenv("GOOGLE_CREDENTIALS_JSON")
 ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x}
 POLL_MINUTES = int(os.getenv("POLL_MINUTES", "3"))
 GOOGLE_CREDENTIALS_FILE = os.getenv("GOOGLE_CREDENTIALS_FILE")
+SHEETS_WS_CACHE_TTL = int(os.getenv("SHEETS_WS_CACHE_TTL", "3600"))
+SHEETS_HTTP_POOL_SIZE = int(os.getenv("SHEETS_HTTP_POOL_SIZE", "10"))
+SHEETS_CACHE_TTL = int(os.getenv("SHEETS_CACHE_TTL", "30"))
+SHEETS_VIEW_TTL = int(os.getenv("SHEETS_VIEW_TTL", "600"))
+SHEETS_WORKERS = int(os.getenv("SHEETS_WORKERS", "8"))
+SHEETS_TIMEOUT = float(os.getenv("SHEETS_TIMEOUT", "20"))
+SHEETS_WRITE_DELAY = float(os.getenv("SHEETS_WRITE_DELAY", "2"))
+DATA_DIR = os.getenv("DATA_DIR", "data")
+SHEETS_JOURNAL_PATH = os.getenv("SHEETS_JOURNAL_PATH", os.path.join(DATA_DIR, "sheets-journal.jsonl"))
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sheets").strip().lower()
+SQLITE_PATH = os.getenv("SQLITE_PATH", os.path.join(DATA_DIR, "seabluu.db"))
+SYNC_SECONDS = int(os.getenv("SYNC_SECONDS", "30"))
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8"))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_CHAT_RATE = float(os.getenv("BROADCAST_CHAT_RATE", "1"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+BROADCAST_STATE_PATH = os.getenv("BROADCAST_STATE_PATH", os.path.join(DATA_DIR, "broadcast.json"))
+BROADCAST_PROGRESS_SECONDS = float(os.getenv("BROADCAST_PROGRESS_SECONDS", "3"))
+NOTIFY_DIGEST_WINDOW = float(os.getenv("NOTIFY_DIGEST_WINDOW", "3"))
+NOTIFY_DIGEST_MAX = int(os.getenv("NOTIFY_DIGEST_MAX", "20"))
+SHEETS_PROBE_TTL = float(os.getenv("SHEETS_PROBE_TTL", "5"))
+TYPING_DELAY = float(os.getenv("TYPING_DELAY", "0.5"))
+PERSISTENCE_PATH = os.getenv("PERSISTENCE_PATH", os.path.join(DATA_DIR, "user_state.db"))
+PERSISTENCE_SECONDS = float(os.getenv("PERSISTENCE_SECONDS", "10"))
+DIRECTORY_PATH = os.getenv("DIRECTORY_PATH", os.path.join(DATA_DIR, "users.db"))
+DIRECTORY_SYNC_SECONDS = int(os.getenv("DIRECTORY_SYNC_SECONDS", "60"))
+SHEETS_NEGATIVE_TTL = int(os.getenv("SHEETS_NEGATIVE_TTL", "60"))
+LOOKUP_RATE = float(os.getenv("LOOKUP_RATE", "0.5"))
+LOOKUP_BURST = int(os.getenv("LOOKUP_BURST", "5"))
@@ -0,0 +1,103 @@
+# app/digest.py
+"""Сводные уведомления о смене статусов.
+
+Уведомления копятся по user_id в коротком окне (NOTIFY_DIGEST_WINDOW):
+если за это время у человека поменялось несколько заказов, он получает одно
+сообщение со списком, а не по сообщению на заказ. Сводка уходит раньше,
+если набралось NOTIFY_DIGEST_MAX заказов. last_sent_status доставленным
+пишется одной записью на каждую пачку сводок.
+"""
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+from . import broadcast
+from . import sheets_async as asheets
+from .config import NOTIFY_DIGEST_WINDOW, NOTIFY_DIGEST_MAX
+
+logger = logging.getLogger(__name__)
+
+
+def _text(items: List[Tuple[str, str]]) -> str:
+    if len(items) == 1:
+        order_id, status = items[0]
+        return f"🔄 Обновление по заказу *{order_id}*\nНовый статус: *{status}*"
+    lines = ["🔄 Обновления по вашим заказам:"]
+    lines += [f"• *{order_id}* — {status}" for order_id, status in items]
+    return "\n".join(lines)
+
+
+class StatusDigest:
+    def __init__(self, window: float, max_items: int):
+        self.window = window
+        self.max_items = max(1, max_items)
+        self.bot = None
+        # {user_id: {order_id в нижнем регистре: (order_id, status)}} — новый статус затирает старый
+        self._pending: Dict[int, Dict[str, Tuple[str, str]]] = {}
+        self._due: Dict[int, float] = {}
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def add(self, bot, user_id: int, order_id: str, status: str) -> None:
+        """Поставить уведомление в сводку пользователя."""
+        self.bot = bot
+        items = self._pending.setdefault(user_id, {})
+        items[order_id.strip().lower()] = (order_id, status)
+        now = time.monotonic()
+        self._due.setdefault(user_id, now + self.window)
+        if len(items) >= self.max_items:
+            self._due[user_id] = now
+        if self._task is None or self._task.done():
+            self._wake = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._loop())
+        if self._due[user_id] <= now:
+            self._wake.set()
+
+    def pending(self) -> int:
+        return sum(len(items) for items in self._pending.values())
+
+    async def flush(self) -> None:
+        """Отправить все накопленные сводки сейчас (при остановке бота)."""
+        if self._pending:
+            await self._send(list(self._pending))
+
+    async def _loop(self) -> None:
+        while self._pending:
+            now = time.monotonic()
+            due = [uid for uid, t in self._due.items() if t <= now]
+            if due:
+                await self._send(due)
+                continue
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), min(self._due.values()) - now)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _send(self, user_ids: List[int]) -> None:
+        batches = []
+        for uid in user_ids:
+            self._due.pop(uid, None)
+            items = list(self._pending.pop(uid, {}).values())
+            # не больше max_items заказов в одном сообщении
+            for i in range(0, len(items), self.max_items):
+                batches.append((uid, items[i:i + self.max_items]))
+        if not batches:
+            return
+        errors = await broadcast.send_many(
+            self.bot, [(uid, _text(items)) for uid, items in batches], parse_mode="Markdown"
+        )
+        delivered = [
+            (uid, order_id, status)
+            for (uid, items), err in zip(batches, errors) if err is None
+            for order_id, status in items
+        ]
+        if delivered:
+            try:
+                await asheets.set_last_sent_statuses(delivered)
+            except Exception as e:
+                logger.warning("digest: last_sent_status not saved: %s", e)
+
+
+DIGEST = StatusDigest(NOTIFY_DIGEST_WINDOW, NOTIFY_DIGEST_MAX)
@@ -0,0 +1,155 @@
+# app/directory.py
+"""Справочник username -> user_id, собранный из входящих апдейтов.
+
+Напоминания должникам идут по username из participants, а chat_id раньше
+брался только из addresses: кто не сохранял адрес, получал «нет chat_id».
+Теперь каждый апдейт (TypeHandler в группе -1) записывает в память
+(username, user_id, last_seen); раз в DIRECTORY_SYNC_SECONDS изменения
+пачкой уходят в локальную SQLite-базу и в лист users. Поиск по username —
+словарь в памяти. Если локальной базы нет (новый контейнер), справочник
+поднимается из листа users.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from telegram import User
+from telegram.ext import Application, ContextTypes
+
+from . import sheets
+from . import sheets_async as asheets
+from .config import DIRECTORY_PATH, DIRECTORY_SYNC_SECONDS
+
+logger = logging.getLogger(__name__)
+
+_JOB_NAME = "sync_directory"
+_TOUCH = 3600  # last_seen освежаем не чаще раза в час, иначе каждый апдейт — запись
+
+
+def _uname(username: Optional[str]) -> str:
+    return (username or "").strip().lstrip("@").lower()
+
+
+class UserDirectory:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._by_id: Dict[int, Tuple[str, str]] = {}       # user_id -> (username, last_seen)
+        self._by_name: Dict[str, int] = {}
+        self._touched: Dict[int, float] = {}                # user_id -> когда last_seen ставили в очередь
+        self._dirty: Dict[int, Tuple[str, str]] = {}
+
+    def load(self) -> int:
+        """Открыть локальную базу и прочитать справочник (пустую — заполнить из листа). Вернёт число записей."""
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, username TEXT NOT NULL, last_seen TEXT NOT NULL)"
+        )
+        rows = db.execute("SELECT user_id, username, last_seen FROM users").fetchall()
+        if not rows:
+            for r in sheets.list_users():
+                try:
+                    rows.append((int(r.user_id), _uname(r.username), str(r.last_seen)))
+                except (TypeError, ValueError):
+                    continue
+            db.executemany("INSERT OR REPLACE INTO users (user_id, username, last_seen) VALUES (?, ?, ?)", rows)
+        with self._lock:
+            self._db = db
+            for user_id, username, last_seen in rows:
+                # то, что уже пришло апдейтами после старта, новее
+                if user_id not in self._by_id and username:
+                    self._put(user_id, username, last_seen)
+            return len(self._by_id)
+
+    def see(self, user: Optional[User]) -> None:
+        """Запомнить отправителя апдейта (без username искать его не по чему)."""
+        if user is None or user.is_bot or not user.username:
+            return
+        username = _uname(user.username)
+        now = time.monotonic()
+        with self._lock:
+            known = self._by_id.get(user.id)
+            if known and known[0] == username and now - self._touched.get(user.id, -_TOUCH) < _TOUCH:
+                return
+            self._touched[user.id] = now
+            last_seen = datetime.utcnow().isoformat(timespec="seconds")
+            self._put(user.id, username, last_seen)
+            self._dirty[user.id] = (username, last_seen)
+
+    def resolve(self, usernames: Iterable[str]) -> Dict[str, int]:
+        """{username (без @, в нижнем регистре): user_id} для известных справочнику."""
+        result: Dict[str, int] = {}
+        with self._lock:
+            for u in usernames:
+                uname = _uname(u)
+                if uname in self._by_name:
+                    result[uname] = self._by_name[uname]
+        return result
+
+    def sync(self) -> int:
+        """Записать накопленные изменения в базу и в лист users. Вернёт число записей."""
+        with self._lock:
+            batch, self._dirty = self._dirty, {}
+        if not batch:
+            return 0
+        rows = [(user_id, username, last_seen) for user_id, (username, last_seen) in batch.items()]
+        try:
+            if self._db is not None:
+                with self._lock:
+                    self._db.executemany(
+                        "INSERT INTO users (user_id, username, last_seen) VALUES (?, ?, ?) "
+                        "ON CONFLICT(user_id) DO UPDATE SET username = excluded.username, last_seen = excluded.last_seen",
+                        rows,
+                    )
+            sheets.upsert_users(rows)
+        except Exception:
+            with self._lock:
+                for user_id, value in batch.items():
+                    self._dirty.setdefault(user_id, value)
+            raise
+        return len(rows)
+
+    def _put(self, user_id: int, username: str, last_seen: str) -> None:
+        old = self._by_id.get(user_id)
+        if old and old[0] != username and self._by_name.get(old[0]) == user_id:
+            del self._by_name[old[0]]  # человек сменил username
+        self._by_id[user_id] = (username, last_seen)
+        self._by_name[username] = user_id
+
+
+DIRECTORY = UserDirectory(DIRECTORY_PATH)
+
+
+def schedule(application: Application) -> None:
+    """Запланировать синхронизацию справочника (DIRECTORY_SYNC_SECONDS <= 0 — только память)."""
+    if DIRECTORY_SYNC_SECONDS <= 0 or application.job_queue is None:
+        return
+    application.job_queue.run_repeating(
+        _sync, interval=DIRECTORY_SYNC_SECONDS, first=DIRECTORY_SYNC_SECONDS, name=_JOB_NAME
+    )
+
+
+async def _sync(context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        n = await asheets.run(DIRECTORY.sync)
+        if n:
+            logger.info("directory: %s users synced", n)
+    except Exception as e:
+        logger.warning("directory: sync failed, will retry: %s", e)
+
+
+async def user_ids_map(usernames: List[str]) -> Dict[str, int]:
+    """Как sheets.get_user_ids_map, но сначала по справочнику; в addresses — только за ненайденными."""
+    names = {_uname(u) for u in usernames if _uname(u)}
+    found = DIRECTORY.resolve(names)
+    missing = sorted(names - set(found))
+    if missing:
+        found.update(await asheets.get_user_ids_map(missing))
+    return found
@@ -1,8 +1,13 @@
 # app/main.py
 import logging
 import re
+import time
 import asyncio
-from typing import List, Tuple, Dict
+import inspect
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, List, Tuple, Dict
+
+from cachetools import TTLCache
 
 from telegram import (
     Update,
@@ -16,12 +21,17 @@ from telegram.ext import (
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    TypeHandler,
     filters,
 )
 from telegram.constants import ChatAction
 
-from . import sheets
-from .config import ADMIN_IDS
+from . import broadcast
+from .digest import DIGEST
+from .directory import DIRECTORY, user_ids_map
+from . import sheets_async as asheets
+from .config import ADMIN_IDS, TYPING_DELAY, LOOKUP_RATE, LOOKUP_BURST
+from .ratelimit import TokenBucket
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -71,24 +81,64 @@ def is_valid_status(s: str, statuses: list[str]) -> bool:
 def _is_admin(uid) -> bool:
     return uid in ADMIN_IDS or str(uid) in {str(x) for x in ADMIN_IDS}
 
-# -------- небольшая «анимация» ответов (эффект печати) --------
+# user_id -> TokenBucket поиска заказов (опечатки и спам не доходят до таблицы)
+_LOOKUPS: TTLCache = TTLCache(maxsize=10000, ttl=600)
+
+def _lookup_allowed(uid: int) -> bool:
+    """LOOKUP_BURST поисков подряд, дальше LOOKUP_RATE в секунду; админов не ограничиваем."""
+    if _is_admin(uid):
+        return True
+    bucket = _LOOKUPS.get(uid)
+    if bucket is None:
+        bucket = _LOOKUPS[uid] = TokenBucket(LOOKUP_RATE, LOOKUP_BURST)
+    return bucket.try_acquire()
+
+# -------- индикатор «печатает…» и задержка ответов --------
+
+@asynccontextmanager
+async def _typing(context: ContextTypes.DEFAULT_TYPE, chat_id: int, delay: float = TYPING_DELAY):
+    """Оборачивает работу перед ответом: «печатает…» появится, только если она дольше delay.
+
+    Ничего не ждёт сам — блок выполняется сразу, индикатор идёт параллельно.
+    """
+    async def show():
+        await asyncio.sleep(delay)
+        while True:
+            try:
+                await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+            except Exception:
+                pass
+            await asyncio.sleep(4.5)  # Telegram гасит действие через ~5 с
 
-async def _typing(context: ContextTypes.DEFAULT_TYPE, chat_id: int, seconds: float = 0.6):
+    task = asyncio.create_task(show())
     try:
-        await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-    except Exception:
-        pass
-    await asyncio.sleep(seconds)
+        yield
+    finally:
+        task.cancel()
+
+# update_id -> когда бот начал обрабатывать апдейт (для замера задержки ответа)
+_RECEIVED: TTLCache = TTLCache(maxsize=10000, ttl=300)
+
+async def _mark_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    _RECEIVED[update.update_id] = time.monotonic()
+    DIRECTORY.see(update.effective_user)
+
+def _log_latency(update: Update):
+    started = _RECEIVED.get(update.update_id)
+    if started is not None:
+        logger.info("[latency] update %s replied in %.0f ms", update.update_id, (time.monotonic() - started) * 1000)
 
 async def reply_animated(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, **kwargs):
     msg = update.message or update.callback_query.message
-    await _typing(context, msg.chat_id)
-    return await msg.reply_text(text, **kwargs)
+    sent = await msg.reply_text(text, **kwargs)
+    _log_latency(update)
+    return sent
 
 async def reply_markdown_animated(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, **kwargs):
     msg = update.message or update.callback_query.message
-    await _typing(context, msg.chat_id)
-    return await msg.reply_markdown(text, **kwargs)
+    sent = await msg.reply_markdown(text, **kwargs)
+    _log_latency(update)
+    return sent
 
 # ---------------------- Текст кнопок (новые + обратная совместимость) ----------------------
 
@@ -154,9 +204,6 @@ REPORT_ALIASES = {
     "report_unpaid": {BTN_REPORT_UNPAID_NEW, "отчёт по должникам"},
 }
 
-def _is(text: str, group: set[str]) -> bool:
-    return text.strip().lower() in {x.lower() for x in group}
-
 # ---------------------- Клавиатуры ----------------------
 
 MAIN_KB = ReplyKeyboardMarkup(
@@ -308,20 +355,6 @@ def _admin_mode_prompt(mode: str):
                 "например: CN-1001 CN-1002, KR-2003"), None
     # по умолчанию — просто покажем админ-меню
     return "Вы в админ-панели. Выберите действие:", ADMIN_MENU_KB
-    # Короткая причина ошибки отправки
-def _err_reason(e: Exception) -> str:
-    s = str(e).lower()
-    if "forbidden" in s or "blocked" in s:
-        return "бот заблокирован"
-    if "chat not found" in s or "not found" in s:
-        return "нет chat_id"
-    if "bad request" in s:
-        return "bad request"
-    if "retry after" in s or "flood" in s:
-        return "rate limit"
-    if "timeout" in s:
-        return "timeout"
-    return "ошибка"
 
 # ---------------------- Команды ----------------------
 
@@ -356,470 +389,560 @@ async def admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ---------------------- Пользовательские сценарии ----------------------
 
+# Текст сообщения маршрутизируется без цепочки if: кнопки/алиасы -> действие
+# (один словарь на всех, собирается при импорте), шаг мастера -> обработчик
+# (реестры ниже). Новое действие или шаг — это функция с декоратором.
+Handler = Callable[[Update, ContextTypes.DEFAULT_TYPE, str], Awaitable[None]]
+
+ADMIN_ACTIONS: Dict[str, Handler] = {}
+ADMIN_STEPS: Dict[str, Handler] = {}     # adm_mode -> обработчик шага
+USER_ACTIONS: Dict[str, Handler] = {}
+USER_STEPS: Dict[str, Handler] = {}      # mode -> обработчик шага
+
+def _registrar(registry: Dict[str, Handler]):
+    def register(*names: str):
+        def deco(fn: Handler) -> Handler:
+            # не тот обработчик под декоратором — падаем при импорте, а не в диалоге
+            try:
+                inspect.signature(fn).bind(None, None, "")
+            except TypeError:
+                raise TypeError(f"{fn.__name__} must accept (update, context, text)") from None
+            for name in names:
+                registry[name] = fn
+            return fn
+        return deco
+    return register
+
+admin_action = _registrar(ADMIN_ACTIONS)
+admin_step = _registrar(ADMIN_STEPS)
+user_action = _registrar(USER_ACTIONS)
+user_step = _registrar(USER_STEPS)
+
+def _alias_map(*groups: Dict[str, set]) -> Dict[str, str]:
+    """{текст кнопки/алиас в нижнем регистре: действие}; при совпадении побеждает первая группа."""
+    result: Dict[str, str] = {}
+    for group in groups:
+        for action, aliases in group.items():
+            for alias in aliases:
+                result.setdefault(alias.strip().lower(), action)
+    return result
+
+ADMIN_TEXT = _alias_map(ADMIN_MENU_ALIASES, BROADCAST_ALIASES, ADMIN_ADDR_ALIASES, REPORT_ALIASES)
+USER_TEXT = _alias_map(CLIENT_ALIASES)
+
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     raw = (update.message.text or "").strip()
     text = raw.lower()
 
-    # ===== ADMIN FLOW =====
+    # ===== ADMIN FLOW: кнопки меню, затем текущий шаг мастера =====
     if _is_admin(update.effective_user.id):
-
-        if _is(text, ADMIN_MENU_ALIASES["admin_exit"]):
-            context.user_data.clear()
-            await reply_animated(update, context, "🚪 Готово, вышли из админ-панели.", reply_markup=MAIN_KB)
-            return
-
-        if _is(text, ADMIN_MENU_ALIASES["admin_add"]):
-            context.user_data["adm_mode"] = "add_order_id"
-            context.user_data["adm_buf"] = {}
-            await reply_markdown_animated(update, context, "➕ Введи *order_id* (например: `CN-12345`):")
-            return
-
-        if _is(text, ADMIN_MENU_ALIASES["admin_reports"]):
-            await reply_animated(update, context, "📊 Раздел «Отчёты»", reply_markup=REPORTS_MENU_KB)
-            return
-
-        if _is(text, ADMIN_MENU_ALIASES["admin_send"]):
-            await reply_animated(update, context, "📣 Раздел «Рассылка»", reply_markup=BROADCAST_MENU_KB)
-            return
-
-        if _is(text, ADMIN_MENU_ALIASES["admin_addrs"]):
-            await reply_animated(update, context, "📇 Раздел «Адреса»", reply_markup=ADMIN_ADDR_MENU_KB)
-            return
-
-        if _is(text, ADMIN_MENU_ALIASES["admin_mass"]):
-            # шаг 1: выбрать целевой статус из инлайн-клавиатуры
-            context.user_data["adm_mode"] = "mass_pick_status"
-            await reply_animated(
-                update, context,
-                "Выбери новый статус для нескольких заказов:",
-                reply_markup=status_keyboard_with_prefix("mass:pick_status_id")
-            )
-            return
-
-        if _is(text, ADMIN_MENU_ALIASES["back_admin"]):
-            await admin_menu(update, context)
-            return
-
-        # --- Рассылка
-        if _is(text, BROADCAST_ALIASES["bc_all"]):
-            await broadcast_all_unpaid_text(update, context)
-            return
-
-        if _is(text, BROADCAST_ALIASES["bc_one"]):
-            context.user_data["adm_mode"] = "adm_remind_unpaid_order"
-            await reply_markdown_animated(update, context, "✉️ Введи *order_id* для рассылки неплательщикам:")
-            return
-
-        # --- Адреса (подменю)
-        if _is(text, ADMIN_ADDR_ALIASES["export_addrs"]):
-            context.user_data["adm_mode"] = "adm_export_addrs"
-            await reply_animated(update, context, "Пришли список @username (через пробел/запятую/новые строки):")
-            return
-
-        if _is(text, ADMIN_ADDR_ALIASES["edit_addr"]):
-            context.user_data["adm_mode"] = "adm_edit_addr_username"
-            await reply_animated(update, context, "Пришли @username пользователя, чей адрес нужно изменить:")
-            return
-
-        # --- Отчёты (подменю)
-        if _is(text, REPORT_ALIASES["report_by_note"]):
-            context.user_data["adm_mode"] = "adm_export_orders_by_note"
-            await reply_markdown_animated(update, context, "🧾 Пришли метку/слово из *note*, по которому помечены твои разборы:")
+        a_mode = context.user_data.get("adm_mode")
+        action = ADMIN_TEXT.get(text)
+        # «Отследить разбор» посреди мастера — это ввод для шага, а не кнопка
+        if action == "admin_track" and a_mode is not None:
+            action = None
+        if action:
+            await ADMIN_ACTIONS[action](update, context, raw)
             return
-
-        if _is(text, REPORT_ALIASES["report_unpaid"]):
-            await report_unpaid(update, context)
+        step = ADMIN_STEPS.get(a_mode)
+        if step:
+            await step(update, context, raw)
             return
 
-        # --- Отследить разбор
-        if _is(text, ADMIN_MENU_ALIASES["admin_track"]) and (context.user_data.get("adm_mode") is None):
-            context.user_data["adm_mode"] = "find_order"
-            await reply_markdown_animated(update, context, "🔎 Введи *order_id* для поиска:")
-            return
+    # ===== USER FLOW =====
+    action = USER_TEXT.get(text)
+    if action:
+        await USER_ACTIONS[action](update, context, raw)
+        return
+    step = USER_STEPS.get(context.user_data.get("mode"))
+    if step:
+        await step(update, context, raw)
+        return
 
-        # --- Мастера/вводы ---
+  # Ничего не подошло — отдельная ветка для админов и для клиентов
+    if _is_admin(update.effective_user.id):
         a_mode = context.user_data.get("adm_mode")
-
-        # Добавление заказа
-        if a_mode == "add_order_id":
-            context.user_data["adm_buf"] = {"order_id": raw}
-            context.user_data["adm_mode"] = "add_order_client"
-            await reply_animated(update, context, "Имя клиента (можно несколько @username):")
-            return
-
-        if a_mode == "add_order_client":
-            context.user_data["adm_buf"]["client_name"] = raw
-            context.user_data["adm_mode"] = "add_order_country"
-            await reply_animated(update, context, "Страна/склад (CN или KR):")
+        # если админ в конкретном шаге — не выходим, а просим ввести корректно
+        if a_mode:
+            msg, kb = _admin_mode_prompt(a_mode)
+            await reply_animated(update, context, f"⚠️ Не понял. {msg}", reply_markup=kb or ADMIN_MENU_KB)
             return
+        # если админ не в шаге — просто перерисуем админ-меню
+        await reply_animated(update, context, "Вы в админ-панели. Выберите действие:", reply_markup=ADMIN_MENU_KB)
+        return
 
-        if a_mode == "add_order_country":
-            country = raw.upper()
-            if country not in ("CN", "KR"):
-                await reply_animated(update, context, "Введи 'CN' (Китай) или 'KR' (Корея):")
-                return
-            context.user_data["adm_buf"]["country"] = country
-            context.user_data["adm_mode"] = "add_order_status"
-            await reply_animated(update, context, "Выбери стартовый статус кнопкой ниже или напиши точный:", reply_markup=status_keyboard(2))
-            return
+    # Клиентский фолбэк
+    await reply_animated(
+        update, context,
+        "Хмм, не понял. Выберите кнопку ниже или введите номер заказа. Если что — «Отмена».",
+        reply_markup=MAIN_KB,
+    )
 
-        if a_mode == "add_order_status":
-            if not is_valid_status(raw, STATUSES):
-                await reply_animated(update, context, "Выбери статус кнопкой ниже или напиши точный:", reply_markup=status_keyboard(2))
-                return
-            context.user_data["adm_buf"]["status"] = raw.strip()
-            context.user_data["adm_mode"] = "add_order_note"
-            await reply_animated(update, context, "Примечание (или '-' если нет):")
-            return
+# ---------------------- Админ: кнопки меню ----------------------
 
-        if a_mode == "add_order_note":
-            buf = context.user_data.get("adm_buf", {})
-            buf["note"] = raw if raw != "-" else ""
-            try:
-                sheets.add_order({
-                    "order_id": buf["order_id"],
-                    "client_name": buf.get("client_name", ""),
-                    "country": buf.get("country", ""),
-                    "status": buf.get("status", "выкуплен"),
-                    "note": buf.get("note", ""),
-                })
-                usernames = [m.group(1) for m in USERNAME_RE.finditer(buf.get("client_name", ""))]
-                if usernames:
-                    sheets.ensure_participants(buf["order_id"], usernames)
-                await reply_markdown_animated(update, context, f"✅ Заказ *{buf['order_id']}* добавлен")
-            except Exception as e:
-                await reply_animated(update, context, f"Ошибка: {e}")
-            finally:
-                for k in ("adm_mode", "adm_buf"):
-                    context.user_data.pop(k, None)
-            return
+@admin_action("admin_exit")
+async def _admin_exit(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str):
+    context.user_data.clear()
+    await reply_animated(update, context, "🚪 Готово, вышли из админ-панели.", reply_markup=MAIN_KB)
 
-        # Поиск и карточка + участники + кнопка смены статуса
-        if a_mode == "find_order":
-            parsed_id = extract_order_id(raw) or raw
-            order = sheets.get_order(parsed_id)
-            if not order:
-                await reply_animated(update, context, "🙈 Заказ не найден.")
-                context.user_data.pop("adm_mode", None)
-                return
-
-            order_id = order.get("order_id", parsed_id)
-            client_name = order.get("client_name", "—")
-            status = order.get("status", "—")
-            note = order.get("note", "—")
-            country = order.get("country", order.get("origin", "—"))
-            origin = order.get("origin")
-            updated_at = order.get("updated_at")
-
-            head = [
-                f"*order_id:* `{order_id}`",
-                f"*client_name:* {client_name}",
-                f"*status:* {status}",
-                f"*note:* {note}",
-                f"*country:* {country}",
-            ]
-            if origin and origin != country:
-                head.append(f"*origin:* {origin}")
-            if updated_at:
-                head.append(f"*updated_at:* {updated_at}")
-
-            await reply_markdown_animated(update, context, "\n".join(head), reply_markup=order_card_kb(order_id))
-
-            # участники
-            participants = sheets.get_participants(order_id)
-            page = 0; per_page = 8
-            part_text = build_participants_text(order_id, participants, page, per_page)
-            kb = build_participants_kb(order_id, participants, page, per_page)
-            await reply_markdown_animated(update, context, part_text, reply_markup=kb)
-
-            context.user_data.pop("adm_mode", None)
-            return
+@admin_action("admin_add")
+async def _admin_add(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str):
+    context.user_data["adm_mode"] = "add_order_id"
+    context.user_data["adm_buf"] = {}
+    await reply_markdown_animated(update, context, "➕ Введи *order_id* (например: `CN-12345`):")
 
-        # Массовая смена статусов: админ присылает список order_id
-        if a_mode == "mass_update_status_ids":
-            # распарсим произвольный список ID
-            raw_ids = re.split(r"[,\s]+", raw.strip())
-            ids = []
-            seen = set()
-            for token in raw_ids:
-                oid = extract_order_id(token)
-                if oid and oid not in seen:
-                    seen.add(oid)
-                    ids.append(oid)
-
-            if not ids:
-                await reply_animated(update, context, "Не нашёл order_id. Пришли ещё раз (пример: CN-1001 KR-2002).")
-                return
-
-            new_status = context.user_data.get("mass_status")
-            if not new_status:
-                await reply_animated(update, context, "Не выбран новый статус. Повтори с начала: «🧰 Массовая смена статусов».")
-                context.user_data.pop("adm_mode", None)
-                return
-
-            ok, fail = 0, 0
-            failed_ids = []
-            for oid in ids:
-                try:
-                    updated = sheets.update_order_status(oid, new_status)
-                    if updated:
-                        ok += 1
-                        # уведомим подписчиков конкретного заказа
-                        try:
-                            await notify_subscribers(context.application, oid, new_status)
-                        except Exception:
-                            pass
-                    else:
-                        fail += 1
-                        failed_ids.append(oid)
-                except Exception:
-                    fail += 1
-                    failed_ids.append(oid)
-
-            # очистим режим
-            context.user_data.pop("adm_mode", None)
-            context.user_data.pop("mass_status", None)
-
-            # отчёт
-            parts = [
-                "🧰 Массовая смена статусов — итог",
-                f"Всего заказов: {len(ids)}",
-                f"✅ Успешно: {ok}",
-                f"❌ Ошибки: {fail}",
-            ]
-            if failed_ids:
-                parts.append("")
-                parts.append("Не удалось обновить:")
-                parts.append(", ".join(failed_ids))
-            await reply_animated(update, context, "\n".join(parts))
-            return
+@admin_action("admin_reports")
+async def _admin_reports(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str):
+    await reply_animated(update, context, "📊 Раздел «Отчёты»", reply_markup=REPORTS_MENU_KB)
 
-        # Ручная рассылка по одному order_id
-        if a_mode == "adm_remind_unpaid_order":
-            parsed_id = extract_order_id(raw) or raw
-
-            # если такого заказа нет — остаёмся в этом же шаге и просим ввести корректный
-            order = sheets.get_order(parsed_id)
-            if not order:
-                await reply_animated(
-                    update, context,
-                    "🙈 Заказ не найден. Введи корректный *order_id* (например: CN-12345):"
-                )
-                return  # НЕ выходим из админки и шага
-
-            # если заказ есть — шлём рассылку и показываем подробный отчёт
-            ok, report = await remind_unpaid_for_order(context.application, parsed_id)
-            await reply_animated(update, context, report)
-
-            # выходим из шага, но остаёмся в админ-панели
-            context.user_data.pop("adm_mode", None)
-            return
+@admin_action("admin_send")
+async def _admin_send(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str):
+    await reply_animated(update, context, "📣 Раздел «Рассылка»", reply_markup=BROADCAST_MENU_KB)
 
-        # Выгрузить адреса (по списку username)
-        if a_mode == "adm_export_addrs":
-            usernames = [m.group(1) for m in USERNAME_RE.finditer(raw)]
-            if not usernames:
-                await reply_animated(update, context, "Пришли список @username.")
-                return
-            rows = sheets.get_addresses_by_usernames(usernames)
-            if not rows:
-                await reply_animated(update, context, "Адреса не найдены.")
-            else:
-                lines = []
-                for r in rows:
-                    lines.append(
-                        f"@{r.get('username','')}\n"
-                        f"ФИО: {r.get('full_name','')}\n"
-                        f"Телефон: {r.get('phone','')}\n"
-                        f"Город: {r.get('city','')}\n"
-                        f"Адрес: {r.get('address','')}\n"
-                        f"Индекс: {r.get('postcode','')}\n"
-                        "—"
-                    )
-                await reply_animated(update, context, "\n".join(lines))
-            context.user_data.pop("adm_mode", None)
-            return
+@admin_action("admin_addrs")
+async def _admin_addrs(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str):
+    await reply_animated(update, context, "📇 Раздел «Адреса»", reply_markup=ADMIN_ADDR_MENU_KB)
 
-        # Изменить адрес по username — шаги мастера
-        if a_mode == "adm_edit_addr_username":
-            usernames = [m.group(1) for m in USERNAME_RE.finditer(raw)]
-            if not usernames:
-                await reply_animated(update, context, "Пришли @username.")
-                return
-            uname = usernames[0].lower()
-            ids = sheets.get_user_ids_by_usernames([uname])
-            if not ids:
-                await reply_animated(update, context, "Пользователь не найден по username (нет записи в адресах).")
-                context.user_data.pop("adm_mode", None)
-                return
-            context.user_data["adm_mode"] = "adm_edit_addr_fullname"
-            context.user_data["adm_buf"] = {"edit_user_id": ids[0], "edit_username": uname}
-            await reply_animated(update, context, "ФИО (новое значение):")
-            return
+@admin_action("admin_mass")
+async def _admin_mass(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str):
+    # шаг 1: выбрать целевой статус из инлайн-клавиатуры
+    context.user_data["adm_mode"] = "mass_pick_status"
+    await reply_animated(
+        update, context,
+        "Выбери новый статус для нескольких заказов:",
+        reply_markup=status_keyboard_with_prefix("mass:pick_status_id")
+    )
 
-        if a_mode == "adm_edit_addr_fullname":
-            context.user_data.setdefault("adm_buf", {})["full_name"] = raw
-            context.user_data["adm_mode"] = "adm_edit_addr_phone"
-            await reply_animated(update, context, "Телефон:")
-            return
+@admin_action("back_admin")
+async def _back_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str):
+    await admin_menu(update, context)
+
+# --- Рассылка
+@admin_action("bc_all")
+async def _bc_all(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str):
+    await broadcast_all_unpaid_text(update, context)
+
+@admin_action("bc_one")
+async def _bc_one(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str):
+    context.user_data["adm_mode"] = "adm_remind_unpaid_order"
+    await reply_markdown_animated(update, context, "✉️ Введи *order_id* для рассылки неплательщикам:")
+
+# --- Адреса (подменю)
+@admin_action("export_addrs")
+async def _export_addrs(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str):
+    context.user_data["adm_mode"] = "adm_export_addrs"
+    await reply_animated(update, context, "Пришли список @username (через пробел/запятую/новые строки):")
+
+@admin_action("edit_addr")
+async def _edit_addr(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str):
+    context.user_data["adm_mode"] = "adm_edit_addr_username"
+    await reply_animated(update, context, "Пришли @username пользователя, чей адрес нужно изменить:")
+
+# --- Отчёты (подменю)
+@admin_action("report_by_note")
+async def _report_by_note(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str):
+    context.user_data["adm_mode"] = "adm_export_orders_by_note"
+    await reply_markdown_animated(update, context, "🧾 Пришли метку/слово из *note*, по которому помечены твои разборы:")
+
+@admin_action("report_unpaid")
+async def _report_unpaid(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str):
+    await report_unpaid(update, context)
+
+# --- Отследить разбор (только вне мастера — см. handle_text)
+@admin_action("admin_track")
+async def _admin_track(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str):
+    context.user_data["adm_mode"] = "find_order"
+    await reply_markdown_animated(update, context, "🔎 Введи *order_id* для поиска:")
+
+# ---------------------- Админ: шаги мастеров (adm_mode) ----------------------
+
+# Добавление заказа
+@admin_step("add_order_id")
+async def _add_order_id(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str):
+    context.user_data["adm_buf"] = {"order_id": raw}
+    context.user_data["adm_mode"] = "add_order_client"
+    await reply_animated(update, context, "Имя клиента (можно несколько @username):")
+
+@admin_step("add_order_client")
+async def _add_order_client(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str):
+    context.user_data["adm_buf"]["client_name"] = raw
+    context.user_data["adm_mode"] = "add_order_country"
+    await reply_animated(update, context, "Страна/склад (CN или KR):")
+
+@admin_step("add_order_country")
+async def _add_order_country(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str):
+    country = raw.upper()
+    if country not in ("CN", "KR"):
+        await reply_animated(update, context, "Введи 'CN' (Китай) или 'KR' (Корея):")
+        return
+    context.user_data["adm_buf"]["country"] = country
+    context.user_data["adm_mode"] = "add_order_status"
+    await reply_animated(update, context, "Выбери стартовый статус кнопкой ниже или напиши точный:", reply_markup=status_keyboard(2))
+
+@admin_step("add_order_status")
+async def _add_order_status(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str):
+    if not is_valid_status(raw, STATUSES):
+        await reply_animated(update, context, "Выбери статус кнопкой ниже или напиши точный:", reply_markup=status_keyboard(2))
+        return
+    context.user_data["adm_buf"]["status"] = raw.strip()
+    context.user_data["adm_mode"] = "add_order_note"
+    await reply_animated(update, context, "Примечание (или '-' если нет):")
+
+@admin_step("add_order_note")
+async def _add_order_note(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str):
+    buf = context.user_data.get("adm_buf", {})
+    buf["note"] = raw if raw != "-" else ""
+    try:
+        await asheets.add_order({
+            "order_id": buf["order_id"],
+            "client_name": buf.get("client_name", ""),
+            "country": buf.get("country", ""),
+            "status": buf.get("status", "выкуплен"),
+            "note": buf.get("note", ""),
+        })
+        usernames = [m.group(1) for m in USERNAME_RE.finditer(buf.get("client_name", ""))]
+        if usernames:
+            await asheets.ensure_participants(buf["order_id"], usernames)
+        await reply_markdown_animated(update, context, f"✅ Заказ *{buf['order_id']}* добавлен")
+    except Exception as e:
+        await reply_animated(update, context, f"Ошибка: {e}")
+    finally:
+        for k in ("adm_mode", "adm_buf"):
+            context.user_data.pop(k, None)
+
+async def _suggest_kb(order_id: str, action: str) -> InlineKeyboardMarkup | None:
+    """Кнопки «Возможно, вы имели в виду» с похожими номерами (None — похожих нет)."""
+    hints = await asheets.suggest_order_ids(order_id)
+    if not hints:
+        return None
+    return InlineKeyboardMarkup([[InlineKeyboardButton(f"🔎 {oid}", callback_data=f"{action}:{oid}")] for oid in hints])
+
+# Поиск и карточка + участники + кнопка смены статуса
+@admin_step("find_order")
+async def _find_order(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str, normalize: bool = True):
+    # normalize=False — номер с кнопки-подсказки, он уже точно как в листе
+    parsed_id = (extract_order_id(raw) or raw) if normalize else raw
+    # заказ и участники одним запросом к таблице
+    async with _typing(context, update.effective_chat.id):
+        card = await asheets.get_order_card(parsed_id)
+    order = card["order"]
+    if not order:
+        kb = await _suggest_kb(parsed_id, "adm:find")
+        if kb:
+            await reply_animated(update, context, "🙈 Заказ не найден. Возможно, вы имели в виду:", reply_markup=kb)
+        else:
+            await reply_animated(update, context, "🙈 Заказ не найден.")
+        context.user_data.pop("adm_mode", None)
+        return
 
-        if a_mode == "adm_edit_addr_phone":
-            context.user_data["adm_buf"]["phone"] = raw
-            context.user_data["adm_mode"] = "adm_edit_addr_city"
-            await reply_animated(update, context, "Город:")
-            return
+    order_id = order.get("order_id", parsed_id)
+    client_name = order.get("client_name", "—")
+    status = order.get("status", "—")
+    note = order.get("note", "—")
+    country = order.get("country", order.get("origin", "—"))
+    origin = order.get("origin")
+    updated_at = order.get("updated_at")
+
+    head = [
+        f"*order_id:* `{order_id}`",
+        f"*client_name:* {client_name}",
+        f"*status:* {status}",
+        f"*note:* {note}",
+        f"*country:* {country}",
+    ]
+    if origin and origin != country:
+        head.append(f"*origin:* {origin}")
+    if updated_at:
+        head.append(f"*updated_at:* {updated_at}")
+
+    await reply_markdown_animated(update, context, "\n".join(head), reply_markup=order_card_kb(order_id))
+
+    # участники
+    participants = card["participants"]
+    page = 0; per_page = 8
+    part_text = build_participants_text(order_id, participants, page, per_page)
+    kb = build_participants_kb(order_id, participants, page, per_page)
+    await reply_markdown_animated(update, context, part_text, reply_markup=kb)
+
+    context.user_data.pop("adm_mode", None)
+
+# Массовая смена статусов: админ присылает список order_id
+@admin_step("mass_update_status_ids")
+async def _mass_update_status_ids(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str):
+    # распарсим произвольный список ID
+    raw_ids = re.split(r"[,\s]+", raw.strip())
+    ids = []
+    seen = set()
+    for token in raw_ids:
+        oid = extract_order_id(token)
+        if oid and oid not in seen:
+            seen.add(oid)
+            ids.append(oid)
+
+    if not ids:
+        await reply_animated(update, context, "Не нашёл order_id. Пришли ещё раз (пример: CN-1001 KR-2002).")
+        return
 
-        if a_mode == "adm_edit_addr_city":
-            context.user_data["adm_buf"]["city"] = raw
-            context.user_data["adm_mode"] = "adm_edit_addr_address"
-            await reply_animated(update, context, "Адрес:")
-            return
+    new_status = context.user_data.get("mass_status")
+    if not new_status:
+        await reply_animated(update, context, "Не выбран новый статус. Повтори с начала: «🧰 Массовая смена статусов».")
+        context.user_data.pop("adm_mode", None)
+        return
 
-        if a_mode == "adm_edit_addr_address":
-            context.user_data["adm_buf"]["address"] = raw
-            context.user_data["adm_mode"] = "adm_edit_addr_postcode"
-            await reply_animated(update, context, "Почтовый индекс:")
-            return
+    # все заказы одним чтением и одной записью в таблицу
+    try:
+        results = await asheets.bulk_update_order_status(ids, new_status)
+    except Exception as e:
+        # квота/сеть/доступ — не «заказы не найдены»; режим оставляем, чтобы можно было повторить
+        logger.exception("mass update: bulk_update_order_status failed for %s orders", len(ids))
+        await reply_animated(
+            update, context,
+            f"⚠️ Не удалось обновить статусы: {e}\nПришлите список ещё раз, чтобы повторить.",
+        )
+        return
+    updated_ids = [oid for oid in ids if results.get(oid)]
+    failed_ids = [oid for oid in ids if not results.get(oid)]
+    ok, fail = len(updated_ids), len(failed_ids)
 
-        if a_mode == "adm_edit_addr_postcode":
-            buf = context.user_data.get("adm_buf", {})
-            try:
-                sheets.upsert_address(
-                    user_id=buf["edit_user_id"],
-                    username=buf.get("edit_username",""),
-                    full_name=buf.get("full_name",""),
-                    phone=buf.get("phone",""),
-                    city=buf.get("city",""),
-                    address=buf.get("address",""),
-                    postcode=raw,
-                )
-                await reply_animated(update, context, "✅ Адрес обновлён")
-            except Exception as e:
-                await reply_animated(update, context, f"Ошибка: {e}")
-            finally:
-                context.user_data.pop("adm_mode", None)
-                context.user_data.pop("adm_buf", None)
-            return
+    # уведомим подписчиков обновлённых заказов (параллельно по всем заказам)
+    try:
+        await notify_orders(context.application, updated_ids, new_status)
+    except Exception as e:
+        logger.warning(f"mass update: notify failed: {e}")
+
+    # очистим режим
+    context.user_data.pop("adm_mode", None)
+    context.user_data.pop("mass_status", None)
+
+    # отчёт
+    parts = [
+        "🧰 Массовая смена статусов — итог",
+        f"Всего заказов: {len(ids)}",
+        f"✅ Успешно: {ok}",
+        f"❌ Ошибки: {fail}",
+    ]
+    if failed_ids:
+        parts.append("")
+        parts.append("Не удалось обновить:")
+        parts.append(", ".join(failed_ids))
+    await reply_animated(update, context, "\n".join(parts))
+
+# Ручная рассылка по одному order_id
+@admin_step("adm_remind_unpaid_order")
+async def _adm_remind_unpaid_order(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str):
+    parsed_id = extract_order_id(raw) or raw
+
+    # если такого заказа нет — остаёмся в этом же шаге и просим ввести корректный
+    order = await asheets.get_order(parsed_id)
+    if not order:
+        await reply_animated(
+            update, context,
+            "🙈 Заказ не найден. Введи корректный *order_id* (например: CN-12345):"
+        )
+        return  # НЕ выходим из админки и шага
 
-        # Выгрузить разборы по note
-        if a_mode == "adm_export_orders_by_note":
-            marker = raw.strip()
-            if not marker:
-                await reply_animated(update, context, "Пришли метку/слово для поиска в note.")
-                return
-            orders = sheets.get_orders_by_note(marker)
-            if not orders:
-                await reply_animated(update, context, "Ничего не найдено.")
-            else:
-                lines = []
-                for o in orders:
-                    lines.append(
-                        f"*order_id:* `{o.get('order_id','')}`\n"
-                        f"*client_name:* {o.get('client_name','')}\n"
-                        f"*phone:* {o.get('phone','')}\n"
-                        f"*origin:* {o.get('origin','')}\n"
-                        f"*status:* {o.get('status','')}\n"
-                        f"*note:* {o.get('note','')}\n"
-                        f"*country:* {o.get('country','')}\n"
-                        f"*updated_at:* {o.get('updated_at','')}\n"
-                        "—"
-                    )
-                await reply_markdown_animated(update, context, "\n".join(lines))
-            context.user_data.pop("adm_mode", None)
-            return
+    # если заказ есть — шлём рассылку и показываем подробный отчёт
+    ok, report = await remind_unpaid_for_order(context.application, parsed_id)
+    await reply_animated(update, context, report)
 
-    # ===== USER FLOW =====
-    if _is(text, CLIENT_ALIASES["cancel"]):
-        context.user_data["mode"] = None
-        await reply_animated(update, context, "Отменили действие. Что дальше? 🙂", reply_markup=MAIN_KB)
-        return
+    # выходим из шага, но остаёмся в админ-панели
+    context.user_data.pop("adm_mode", None)
 
-    if _is(text, CLIENT_ALIASES["track"]):
-        context.user_data["mode"] = "track"
-        await reply_animated(update, context, "🔎 Отправьте номер заказа (например: CN-12345):")
+# Выгрузить адреса (по списку username)
+@admin_step("adm_export_addrs")
+async def _adm_export_addrs(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str):
+    usernames = [m.group(1) for m in USERNAME_RE.finditer(raw)]
+    if not usernames:
+        await reply_animated(update, context, "Пришли список @username.")
         return
+    rows = await asheets.get_addresses_by_usernames(usernames)
+    if not rows:
+        await reply_animated(update, context, "Адреса не найдены.")
+    else:
+        lines = []
+        for r in rows:
+            lines.append(
+                f"@{r.get('username','')}\n"
+                f"ФИО: {r.get('full_name','')}\n"
+                f"Телефон: {r.get('phone','')}\n"
+                f"Город: {r.get('city','')}\n"
+                f"Адрес: {r.get('address','')}\n"
+                f"Индекс: {r.get('postcode','')}\n"
+                "—"
+            )
+        await reply_animated(update, context, "\n".join(lines))
+    context.user_data.pop("adm_mode", None)
 
-    if _is(text, CLIENT_ALIASES["addrs"]):
-        context.user_data["mode"] = None
-        await show_addresses(update, context)
+# Изменить адрес по username — шаги мастера
+@admin_step("adm_edit_addr_username")
+async def _adm_edit_addr_username(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str):
+    usernames = [m.group(1) for m in USERNAME_RE.finditer(raw)]
+    if not usernames:
+        await reply_animated(update, context, "Пришли @username.")
         return
-
-    if _is(text, CLIENT_ALIASES["subs"]):
-        context.user_data["mode"] = None
-        await show_subscriptions(update, context)
+    uname = usernames[0].lower()
+    ids = await asheets.get_user_ids_by_usernames([uname])
+    if not ids:
+        await reply_animated(update, context, "Пользователь не найден по username (нет записи в адресах).")
+        context.user_data.pop("adm_mode", None)
         return
-
-    mode = context.user_data.get("mode")
-    if mode == "track":
-        await query_status(update, context, raw)
+    context.user_data["adm_mode"] = "adm_edit_addr_fullname"
+    context.user_data["adm_buf"] = {"edit_user_id": ids[0], "edit_username": uname}
+    await reply_animated(update, context, "ФИО (новое значение):")
+
+@admin_step("adm_edit_addr_fullname")
+async def _adm_edit_addr_fullname(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str):
+    context.user_data.setdefault("adm_buf", {})["full_name"] = raw
+    context.user_data["adm_mode"] = "adm_edit_addr_phone"
+    await reply_animated(update, context, "Телефон:")
+
+@admin_step("adm_edit_addr_phone")
+async def _adm_edit_addr_phone(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str):
+    context.user_data["adm_buf"]["phone"] = raw
+    context.user_data["adm_mode"] = "adm_edit_addr_city"
+    await reply_animated(update, context, "Город:")
+
+@admin_step("adm_edit_addr_city")
+async def _adm_edit_addr_city(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str):
+    context.user_data["adm_buf"]["city"] = raw
+    context.user_data["adm_mode"] = "adm_edit_addr_address"
+    await reply_animated(update, context, "Адрес:")
+
+@admin_step("adm_edit_addr_address")
+async def _adm_edit_addr_address(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str):
+    context.user_data["adm_buf"]["address"] = raw
+    context.user_data["adm_mode"] = "adm_edit_addr_postcode"
+    await reply_animated(update, context, "Почтовый индекс:")
+
+@admin_step("adm_edit_addr_postcode")
+async def _adm_edit_addr_postcode(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str):
+    buf = context.user_data.get("adm_buf", {})
+    try:
+        await asheets.upsert_address(
+            user_id=buf["edit_user_id"],
+            username=buf.get("edit_username",""),
+            full_name=buf.get("full_name",""),
+            phone=buf.get("phone",""),
+            city=buf.get("city",""),
+            address=buf.get("address",""),
+            postcode=raw,
+        )
+        await reply_animated(update, context, "✅ Адрес обновлён")
+    except Exception as e:
+        await reply_animated(update, context, f"Ошибка: {e}")
+    finally:
+        context.user_data.pop("adm_mode", None)
+        context.user_data.pop("adm_buf", None)
+
+# Выгрузить разборы по note
+@admin_step("adm_export_orders_by_note")
+async def _adm_export_orders_by_note(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str):
+    marker = raw.strip()
+    if not marker:
+        await reply_animated(update, context, "Пришли метку/слово для поиска в note.")
         return
+    orders = await asheets.get_orders_by_note(marker)
+    if not orders:
+        await reply_animated(update, context, "Ничего не найдено.")
+    else:
+        lines = []
+        for o in orders:
+            lines.append(
+                f"*order_id:* `{o.get('order_id','')}`\n"
+                f"*client_name:* {o.get('client_name','')}\n"
+                f"*phone:* {o.get('phone','')}\n"
+                f"*origin:* {o.get('origin','')}\n"
+                f"*status:* {o.get('status','')}\n"
+                f"*note:* {o.get('note','')}\n"
+                f"*country:* {o.get('country','')}\n"
+                f"*updated_at:* {o.get('updated_at','')}\n"
+                "—"
+            )
+        await reply_markdown_animated(update, context, "\n".join(lines))
+    context.user_data.pop("adm_mode", None)
 
-    # ====== Мастер адреса (как раньше) ======
-    if mode == "add_address_fullname":
-        context.user_data["full_name"] = raw
-        await reply_animated(update, context, "📞 Телефон (пример: 87001234567):")
-        context.user_data["mode"] = "add_address_phone"
-        return
+# ---------------------- Клиент: кнопки и шаги (mode) ----------------------
 
-    if mode == "add_address_phone":
-        normalized = raw.strip().replace(" ", "").replace("-", "")
-        if normalized.startswith("+7"): normalized = "8" + normalized[2:]
-        elif normalized.startswith("7"): normalized = "8" + normalized[1:]
-        if not (normalized.isdigit() and len(normalized) == 11 and normalized.startswith("8")):
-            await reply_animated(update, context, "Нужно 11 цифр и обязательно с 8. Пример: 87001234567\nВведи номер ещё раз или нажми «Отмена».")
-            return
-        context.user_data["phone"] = normalized
-        await reply_animated(update, context, "🏙 Город (пример: Астана):")
-        context.user_data["mode"] = "add_address_city"
-        return
+@user_action("cancel")
+async def _user_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str):
+    context.user_data["mode"] = None
+    await reply_animated(update, context, "Отменили действие. Что дальше? 🙂", reply_markup=MAIN_KB)
 
-    if mode == "add_address_city":
-        context.user_data["city"] = raw
-        await reply_animated(update, context, "🏠 Адрес (свободный формат):")
-        context.user_data["mode"] = "add_address_address"
-        return
+@user_action("track")
+async def _user_track(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str):
+    context.user_data["mode"] = "track"
+    await reply_animated(update, context, "🔎 Отправьте номер заказа (например: CN-12345):")
 
-    if mode == "add_address_address":
-        context.user_data["address"] = raw
-        await reply_animated(update, context, "📮 Почтовый индекс (пример: 010000):")
-        context.user_data["mode"] = "add_address_postcode"
-        return
+@user_action("addrs")
+async def _user_addrs(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str):
+    context.user_data["mode"] = None
+    await show_addresses(update, context)
 
-    if mode == "add_address_postcode":
-        if not (raw.isdigit() and 5 <= len(raw) <= 6):
-            await reply_animated(update, context, "Индекс выглядит странно. Пример: 010000\nВведи индекс ещё раз или нажми «Отмена».")
-            return
-        context.user_data["postcode"] = raw
-        await save_address(update, context)
+@user_action("subs")
+async def _user_subs(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str):
+    context.user_data["mode"] = None
+    await show_subscriptions(update, context)
+
+@user_step("track")
+async def _track_input(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str):
+    await query_status(update, context, raw)
+
+# ====== Мастер адреса (как раньше) ======
+@user_step("add_address_fullname")
+async def _add_address_fullname(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str):
+    context.user_data["full_name"] = raw
+    await reply_animated(update, context, "📞 Телефон (пример: 87001234567):")
+    context.user_data["mode"] = "add_address_phone"
+
+@user_step("add_address_phone")
+async def _add_address_phone(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str):
+    normalized = raw.strip().replace(" ", "").replace("-", "")
+    if normalized.startswith("+7"): normalized = "8" + normalized[2:]
+    elif normalized.startswith("7"): normalized = "8" + normalized[1:]
+    if not (normalized.isdigit() and len(normalized) == 11 and normalized.startswith("8")):
+        await reply_animated(update, context, "Нужно 11 цифр и обязательно с 8. Пример: 87001234567\nВведи номер ещё раз или нажми «Отмена».")
         return
-
-  # Ничего не подошло — отдельная ветка для админов и для клиентов
-    if _is_admin(update.effective_user.id):
-        a_mode = context.user_data.get("adm_mode")
-        # если админ в конкретном шаге — не выходим, а просим ввести корректно
-        if a_mode:
-            msg, kb = _admin_mode_prompt(a_mode)
-            await reply_animated(update, context, f"⚠️ Не понял. {msg}", reply_markup=kb or ADMIN_MENU_KB)
-            return
-        # если админ не в шаге — просто перерисуем админ-меню
-        await reply_animated(update, context, "Вы в админ-панели. Выберите действие:", reply_markup=ADMIN_MENU_KB)
+    context.user_data["phone"] = normalized
+    await reply_animated(update, context, "🏙 Город (пример: Астана):")
+    context.user_data["mode"] = "add_address_city"
+
+@user_step("add_address_city")
+async def _add_address_city(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str):
+    context.user_data["city"] = raw
+    await reply_animated(update, context, "🏠 Адрес (свободный формат):")
+    context.user_data["mode"] = "add_address_address"
+
+@user_step("add_address_address")
+async def _add_address_address(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str):
+    context.user_data["address"] = raw
+    await reply_animated(update, context, "📮 Почтовый индекс (пример: 010000):")
+    context.user_data["mode"] = "add_address_postcode"
+
+@user_step("add_address_postcode")
+async def _add_address_postcode(update: Update, context: ContextTypes.DEFAULT_TYPE, raw: str):
+    if not (raw.isdigit() and 5 <= len(raw) <= 6):
+        await reply_animated(update, context, "Индекс выглядит странно. Пример: 010000\nВведи индекс ещё раз или нажми «Отмена».")
         return
-
-    # Клиентский фолбэк
-    await reply_animated(
-        update, context,
-        "Хмм, не понял. Выберите кнопку ниже или введите номер заказа. Если что — «Отмена».",
-        reply_markup=MAIN_KB,
-    )
+    context.user_data["postcode"] = raw
+    await save_address(update, context)
 
 # ---------------------- Клиент: статус/подписки/адреса ----------------------
 
-async def query_status(update: Update, context: ContextTypes.DEFAULT_TYPE, order_id: str):
-    await _typing(context, update.effective_chat.id, 0.5)
-    order_id = extract_order_id(order_id) or order_id
-    order = sheets.get_order(order_id)
+async def query_status(update: Update, context: ContextTypes.DEFAULT_TYPE, order_id: str, normalize: bool = True):
+    if not _lookup_allowed(update.effective_user.id):
+        await reply_animated(update, context, "⏳ Слишком много запросов подряд. Подождите пару секунд и отправьте номер ещё раз.")
+        return
+    if normalize:
+        order_id = extract_order_id(order_id) or order_id
+    async with _typing(context, update.effective_chat.id):
+        order = await asheets.get_order(order_id)
+        subscribed = bool(order) and await asheets.is_subscribed(update.effective_user.id, order_id)
     if not order:
-        await reply_animated(update, context, "🙈 Такой заказ не найден. Проверьте номер или повторите позже.")
+        kb = await _suggest_kb(order_id, "track")
+        if kb:
+            await reply_animated(update, context, "🙈 Такой заказ не найден. Возможно, вы имели в виду:", reply_markup=kb)
+        else:
+            await reply_animated(update, context, "🙈 Такой заказ не найден. Проверьте номер или повторите позже.")
         return
     status = order.get("status") or "статус не указан"
     origin = order.get("origin") or ""
@@ -827,7 +950,7 @@ async def query_status(update: Update, context: ContextTypes.DEFAULT_TYPE, order
     if origin:
         txt += f"\nСтрана/источник: {origin}"
 
-    if sheets.is_subscribed(update.effective_user.id, order_id):
+    if subscribed:
         kb = InlineKeyboardMarkup([[InlineKeyboardButton("🔕 Отписаться", callback_data=f"unsub:{order_id}")]])
     else:
         kb = InlineKeyboardMarkup([[InlineKeyboardButton("🔔 Подписаться на обновления", callback_data=f"sub:{order_id}")]])
@@ -835,8 +958,8 @@ async def query_status(update: Update, context: ContextTypes.DEFAULT_TYPE, order
     context.user_data["mode"] = None
 
 async def show_addresses(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await _typing(context, update.effective_chat.id, 0.4)
-    addrs = sheets.list_addresses(update.effective_user.id)
+    async with _typing(context, update.effective_chat.id):
+        addrs = await asheets.list_addresses(update.effective_user.id)
     if not addrs:
         await reply_animated(
             update, context,
@@ -857,7 +980,7 @@ async def show_addresses(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def save_address(update: Update, context: ContextTypes.DEFAULT_TYPE):
     u = update.effective_user
-    sheets.upsert_address(
+    await asheets.upsert_address(
         user_id=u.id,
         username=u.username or "",
         full_name=context.user_data.get("full_name", ""),
@@ -869,8 +992,8 @@ async def save_address(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # автоподписка на свои разборы (если есть username в participants)
     try:
         if u.username:
-            for oid in sheets.find_orders_for_username(u.username):
-                try: sheets.subscribe(u.id, oid)
+            for oid in await asheets.find_orders_for_username(u.username):
+                try: await asheets.subscribe(u.id, oid)
                 except Exception: pass
     except Exception as e:
         logger.warning(f"auto-subscribe failed: {e}")
@@ -887,8 +1010,8 @@ async def save_address(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await reply_animated(update, context, msg, reply_markup=MAIN_KB)
 
 async def show_subscriptions(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await _typing(context, update.effective_chat.id, 0.4)
-    subs = sheets.list_subscriptions(update.effective_user.id)
+    async with _typing(context, update.effective_chat.id):
+        subs = await asheets.list_subscriptions(update.effective_user.id)
     if not subs:
         await reply_animated(update, context, "Пока нет подписок. Отследите заказ и нажмите «Подписаться».")
         return
@@ -903,28 +1026,44 @@ async def show_subscriptions(update: Update, context: ContextTypes.DEFAULT_TYPE)
 # ---------- Уведомления подписчикам ----------
 
 async def notify_subscribers(application, order_id: str, new_status: str):
-    """Шлём всем подписчикам заказа. last_sent_status обновляем в таблице."""
+    """Шлём подписчикам заказа, которым этот статус ещё не отправляли."""
+    await notify_orders(application, [order_id], new_status)
+
+async def notify_orders(application, order_ids: List[str], new_status: str):
+    """Уведомить подписчиков сразу нескольких заказов о новом статусе.
+
+    Уведомления уходят через сводки DIGEST: подписчик нескольких заказов
+    получит одно сообщение со всеми изменениями.
+    """
+    seen = set(); uniq = []
+    for oid in order_ids:
+        if oid.strip().lower() not in seen:
+            uniq.append(oid); seen.add(oid.strip().lower())
+    order_ids = uniq
+    per_order = await asyncio.gather(*(_subscriber_ids(oid, new_status) for oid in order_ids))
+    for oid, uids in zip(order_ids, per_order):
+        for uid in uids:
+            DIGEST.add(application.bot, uid, oid, new_status)
+
+async def _subscriber_ids(order_id: str, new_status: str) -> List[int]:
+    """chat_id подписчиков заказа, которые ещё не получали new_status."""
     try:
-        subs_all = sheets.get_all_subscriptions()
-        targets = [s for s in subs_all if str(s.get("order_id")) == str(order_id)]
+        targets = await asheets.get_subscribers(order_id)
     except Exception:
         # fallback: рассылка по участникам разбора
-        usernames = sheets.get_unpaid_usernames(order_id) + [p.get("username") for p in sheets.get_participants(order_id)]
-        user_ids = list(set(sheets.get_user_ids_by_usernames([u for u in usernames if u])))
+        usernames = await asheets.get_unpaid_usernames(order_id) + [p.get("username") for p in await asheets.get_participants(order_id)]
+        user_ids = list(set((await user_ids_map([u for u in usernames if u])).values()))
         targets = [{"user_id": uid, "order_id": order_id} for uid in user_ids]
 
+    uids = []
     for s in targets:
-        uid = int(s["user_id"])
+        if str(s.get("last_sent_status", "")).strip() == new_status.strip():
+            continue  # уже получал этот статус
         try:
-            await application.bot.send_message(
-                chat_id=uid,
-                text=f"🔄 Обновление по заказу *{order_id}*\nНовый статус: *{new_status}*",
-                parse_mode="Markdown",
-            )
-            try: sheets.set_last_sent_status(uid, order_id, new_status)
-            except Exception: pass
-        except Exception as e:
-            logger.warning(f"notify_subscribers fail to {uid}: {e}")
+            uids.append(int(s["user_id"]))
+        except Exception:
+            continue
+    return list(dict.fromkeys(uids))
 
 # ---------- Напоминания об оплате ----------
 
@@ -933,58 +1072,32 @@ async def remind_unpaid_for_order(application, order_id: str) -> tuple[bool, str
     Шлёт напоминание неплательщикам ТОЛЬКО по указанному order_id
     и возвращает (было_ли_кому_слать, подробный_отчёт_в_markdown).
     """
-    order = sheets.get_order(order_id)
+    order = await asheets.get_order(order_id)
     if not order:
         return False, "🙈 Заказ не найден."
 
-    usernames = sheets.get_unpaid_usernames(order_id)  # список username без @
+    usernames = await asheets.get_unpaid_usernames(order_id)  # список username без @
     if not usernames:
         return False, f"🎉 По заказу *{order_id}* должников нет — красота!"
 
     lines = [f"📩 Уведомления по ID разбора — {order_id}"]
     ok_cnt, fail_cnt = 0, 0
 
-    for uname in usernames:
-        ids = []
-        try:
-            ids = sheets.get_user_ids_by_usernames([uname])  # [uid] или []
-        except Exception:
-            pass
-
-        if not ids:
-            fail_cnt += 1
-            lines.append(f"• ❌ @{uname} — нет chat_id")
-            continue
-
-        uid = ids[0]
-        try:
-            # на всякий случай подпишем, чтобы получил будущие статусы
-            try:
-                sheets.subscribe(uid, order_id)
-            except Exception:
-                pass
-
-            await application.bot.send_message(
-                chat_id=uid,
-                text=(
-                    f"💳 Напоминание по разбору *{order_id}*\n"
-                    f"Статус: *Доставка не оплачена*\n\n"
-                    f"Пожалуйста, оплатите доставку. Если уже оплатили — можно игнорировать."
-                ),
-                parse_mode="Markdown",
-            )
+    report = await broadcast.remind_unpaid(application.bot, {order_id: usernames})
+    for uname, err in report[order_id]:
+        if err is None:
             ok_cnt += 1
             lines.append(f"• ✅ @{uname}")
-        except Exception as e:
+        else:
             fail_cnt += 1
-            lines.append(f"• ❌ @{uname} — {_err_reason(e)}")
+            lines.append(f"• ❌ @{uname} — {broadcast.err_reason(err)}")
 
     lines.append("")
     lines.append(f"_Итого:_ ✅ {ok_cnt}  ❌ {fail_cnt}")
     return True, "\n".join(lines)
 
 async def report_unpaid(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    grouped = sheets.get_all_unpaid_grouped()
+    grouped = await asheets.get_all_unpaid_grouped()
     if not grouped:
         await reply_animated(update, context, "🎉 Должников не найдено — красота!")
         return
@@ -996,73 +1109,15 @@ async def report_unpaid(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def broadcast_all_unpaid_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
-    Шлёт напоминания всем должникам по всем разборам и формирует подробный отчёт:
-    для каждого order_id — список пользователей с ✅/❌ и краткой причиной.
+    Запускает фоновую рассылку напоминаний всем должникам по всем разборам.
+    Прогресс — отдельное сообщение с кнопками остановки/продолжения,
+    подробный отчёт по каждому order_id приходит по окончании.
     """
-    grouped = sheets.get_all_unpaid_grouped()  # {order_id: [username, ...]}
-    if not grouped:
-        await reply_animated(update, context, "🎉 Должников не найдено — красота!")
+    if broadcast.is_busy():
+        await reply_animated(update, context, "⏳ Рассылка уже идёт — следи за сообщением с прогрессом.")
         return
-
-    total_orders = len(grouped)
-    total_ok = 0
-    total_fail = 0
-    blocks: list[str] = []
-
-    for order_id, usernames in grouped.items():
-        order_ok = 0
-        order_fail = 0
-        lines = [f"{order_id}:"]
-
-        # обрабатываем по username, чтобы красиво показать, кому именно ушло/не ушло
-        for uname in usernames:
-            try:
-                ids = sheets.get_user_ids_by_usernames([uname])  # [uid] или []
-                if not ids:
-                    order_fail += 1
-                    lines.append(f"• ❌ @{uname} — нет chat_id")
-                    continue
-
-                uid = ids[0]
-                try:
-                    # подписываем на обновления заказа, чтобы дальше человек получал статусы
-                    try:
-                        sheets.subscribe(uid, order_id)
-                    except Exception:
-                        pass
-
-                    await context.bot.send_message(
-                        chat_id=uid,
-                        text=(
-                            f"💳 Напоминание по разбору *{order_id}*\n"
-                            f"Статус: *Доставка не оплачена*\n\n"
-                            f"Пожалуйста, оплатите доставку. Если уже оплатили — можно игнорировать."
-                        ),
-                        parse_mode="Markdown",
-                    )
-                    order_ok += 1
-                    lines.append(f"• ✅ @{uname}")
-                except Exception as e:
-                    order_fail += 1
-                    lines.append(f"• ❌ @{uname} — {_err_reason(e)}")
-            except Exception as e:
-                order_fail += 1
-                lines.append(f"• ❌ @{uname} — {_err_reason(e)}")
-
-        total_ok += order_ok
-        total_fail += order_fail
-        lines.append(f"_Итого по разбору:_ ✅ {order_ok}  ❌ {order_fail}")
-        blocks.append("\n".join(lines))
-
-    summary = "\n".join([
-    "📣 Уведомления всем должникам — итог",
-    f"Разборов: {total_orders}",
-    f"✅ Успешно: {total_ok}",
-    f"❌ Ошибок: {total_fail}",
-    "",
-    *blocks,
-])
-    await reply_animated(update, context, summary)
+    if not await broadcast.start_unpaid(context.application, update.effective_chat.id):
+        await reply_animated(update, context, "🎉 Должников не найдено — красота!")
 
 # ---------- CallbackQuery ----------
 
@@ -1078,7 +1133,7 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     if data == "addr:del":
-        ok = sheets.delete_address(update.effective_user.id)
+        ok = await asheets.delete_address(update.effective_user.id)
         await reply_animated(update, context, "Адрес удалён ✅" if ok else "Удалять нечего — адрес не найден.")
         return
 
@@ -1098,7 +1153,7 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception:
             await reply_animated(update, context, "Некорректный выбор статуса.")
             return
-        ok = sheets.update_order_status(order_id, new_status)
+        ok = await asheets.update_order_status(order_id, new_status)
         if ok:
             await reply_markdown_animated(update, context, f"✨ Статус *{order_id}* обновлён на: _{new_status}_ ✅")
             await notify_subscribers(context.application, order_id, new_status)
@@ -1145,10 +1200,20 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
+    # подсказка к ненайденному номеру
+    if data.startswith("adm:find:"):
+        if not _is_admin(update.effective_user.id): return
+        await _find_order(update, context, data.split(":", 2)[2], normalize=False)
+        return
+
+    if data.startswith("track:"):
+        await query_status(update, context, data.split(":", 1)[1], normalize=False)
+        return
+
     # подписка/отписка (клиент)
     if data.startswith("sub:"):
         order_id = data.split(":", 1)[1]
-        sheets.subscribe(update.effective_user.id, order_id)
+        await asheets.subscribe(update.effective_user.id, order_id)
         try:
             await q.edit_message_reply_markup(InlineKeyboardMarkup([[InlineKeyboardButton("🔕 Отписаться", callback_data=f"unsub:{order_id}")]]))
         except Exception:
@@ -1158,7 +1223,7 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if data.startswith("unsub:"):
         order_id = data.split(":", 1)[1]
-        sheets.unsubscribe(update.effective_user.id, order_id)
+        await asheets.unsubscribe(update.effective_user.id, order_id)
         await reply_animated(update, context, "Отписка выполнена.")
         try:
             await q.edit_message_reply_markup(InlineKeyboardMarkup([[InlineKeyboardButton("🔔 Подписаться на обновления", callback_data=f"sub:{order_id}")]]))
@@ -1166,11 +1231,21 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             pass
         return
 
+    # фоновая рассылка должникам: стоп/продолжить
+    if data in ("bc:cancel", "bc:resume"):
+        if not _is_admin(update.effective_user.id):
+            return
+        if data == "bc:cancel":
+            await broadcast.cancel(context.bot)
+        else:
+            await broadcast.resume(context.application)
+        return
+
     # управление оплатой участников (тумблеры)
     if data.startswith("pp:toggle:"):
         _, _, order_id, username = data.split(":", 3)
-        sheets.toggle_participant_paid(order_id, username)
-        participants = sheets.get_participants(order_id)
+        await asheets.toggle_participant_paid(order_id, username)
+        participants = await asheets.participants_view(order_id)
         page = 0; per_page = 8
         txt = build_participants_text(order_id, participants, page, per_page)
         kb = build_participants_kb(order_id, participants, page, per_page)
@@ -1183,7 +1258,7 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data.startswith("pp:refresh:"):
         parts = data.split(":")
         order_id = parts[2]; page = int(parts[3]) if len(parts) > 3 else 0
-        participants = sheets.get_participants(order_id)
+        participants = await asheets.participants_view(order_id, fresh=True)
         per_page = 8
         await q.message.edit_text(build_participants_text(order_id, participants, page, per_page),
                                   reply_markup=build_participants_kb(order_id, participants, page, per_page),
@@ -1193,7 +1268,7 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data.startswith("pp:page:"):
         _, _, order_id, page_s = data.split(":")
         page = int(page_s)
-        participants = sheets.get_participants(order_id)
+        participants = await asheets.participants_view(order_id)
         per_page = 8
         await q.message.edit_text(build_participants_text(order_id, participants, page, per_page),
                                   reply_markup=build_participants_kb(order_id, participants, page, per_page),
@@ -1203,6 +1278,8 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ---------------------- Регистрация ----------------------
 
 def register_handlers(application):
+    # отметка времени до всех хэндлеров — для замера задержки ответа
+    application.add_handler(TypeHandler(Update, _mark_received), group=-1)
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_cmd))
     application.add_handler(CommandHandler("admin", admin_menu))
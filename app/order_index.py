@@ -0,0 +1,76 @@
+# app/order_index.py
+"""Подсказки «Возможно, вы имели в виду» для опечаток в номере заказа.
+
+Номер нормализуется (верхний регистр, только буквы и цифры: «cn 1234» и
+«CN-1234» — одно и то же; похожие символы склеены: O и 0, I/L и 1,
+кириллические С/К/Р... и латинские). Индекс — словарь «номер без одного
+символа -> номера»: у двух номеров, отличающихся одной заменой, вставкой,
+удалением или перестановкой соседних символов, есть общий такой вариант.
+Поиск — len(номер) + 1 обращений к словарю, без перебора всех заказов;
+кандидаты ранжируются по расстоянию редактирования.
+
+Индекс строится по снимку orders (sheets.suggest_order_ids): новый
+снимок — новый индекс, дописанные в снимок заказы добавляются через add().
+"""
+import re
+from typing import Dict, Iterable, List, Set
+
+_JUNK_RE = re.compile(r"[^0-9A-ZА-ЯЁ]+")
+# символы, которые путают при наборе номера
+_LOOKALIKE = str.maketrans("OILАВЕКМНОРСТХУЁ", "011ABEKMH0PCTXYE")
+
+
+def normalize(order_id: str) -> str:
+    return _JUNK_RE.sub("", str(order_id or "").upper()).translate(_LOOKALIKE)
+
+
+def _deletes(key: str) -> Set[str]:
+    return {key[:i] + key[i + 1:] for i in range(len(key))}
+
+
+def _distance(q: str, key: str) -> int:
+    """Расстояние между query и кандидатом из индекса (по построению оно не больше 2).
+
+    Разная длина — одна вставка/удаление; одинаковая — одна замена или
+    перестановка соседних символов (1), иначе две правки (2).
+    """
+    if len(q) != len(key):
+        return 1
+    diff = [i for i, (a, b) in enumerate(zip(q, key)) if a != b]
+    if len(diff) <= 1:
+        return len(diff)
+    if len(diff) == 2:
+        i, j = diff
+        if j == i + 1 and q[i] == key[j] and q[j] == key[i]:
+            return 1
+    return 2
+
+
+class OrderIdIndex:
+    def __init__(self, order_ids: Iterable[str]):
+        self._ids: Dict[str, str] = {}            # нормализованный -> как в листе
+        self._variants: Dict[str, List[str]] = {}  # номер без одного символа -> нормализованные номера
+        for oid in order_ids:
+            self.add(oid)
+
+    def add(self, order_id: str) -> None:
+        key = normalize(order_id)
+        if not key or key in self._ids:
+            return
+        self._ids[key] = str(order_id).strip()
+        for v in _deletes(key) | {key}:
+            self._variants.setdefault(v, []).append(key)
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def suggest(self, query: str, limit: int = 3) -> List[str]:
+        """До limit номеров, ближайших к query (не дальше двух правок); точное совпадение — первым."""
+        q = normalize(query)
+        if not q:
+            return []
+        candidates: Set[str] = set()
+        for v in _deletes(q) | {q}:
+            candidates.update(self._variants.get(v, ()))
+        ranked = sorted((_distance(q, key), key) for key in candidates)
+        return [self._ids[key] for _, key in ranked[:limit]]
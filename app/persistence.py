@@ -0,0 +1,158 @@
+# app/persistence.py
+"""user_data бота в SQLite, чтобы рестарт не сбрасывал шаги мастеров.
+
+Хранится только user_data (adm_mode, adm_buf, mode, поля адреса...): одна
+строка JSON на пользователя. При старте ничего не читается — данные
+пользователя подгружаются при первом его апдейте (refresh_user_data).
+PTB раз в PERSISTENCE_SECONDS отдаёт изменённые user_data, они пишутся
+одной транзакцией; строки, которые не поменялись, не переписываются.
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Any, Dict, Optional, Set
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+
+class SqlitePersistence(BasePersistence):
+    def __init__(self, path: str, update_interval: float):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated_at TEXT)"
+        )
+        self._loaded: Set[int] = set()
+        self._saved: Dict[int, str] = {}                # user_id -> JSON, как лежит в базе
+        self._dirty: Dict[int, Optional[str]] = {}      # ещё не записано; None — удалить
+        self._writer: Optional[asyncio.Task] = None
+
+    # ---------- user_data ----------
+
+    async def get_user_data(self) -> Dict[int, Dict[Any, Any]]:
+        return {}  # всё грузится лениво, по первому апдейту пользователя
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict[Any, Any]) -> None:
+        if user_id in self._loaded:
+            return
+        try:
+            raw = await asyncio.to_thread(self._read, user_id)
+        except Exception as e:
+            logger.warning("persistence: user_data of %s not loaded: %s", user_id, e)
+            raw = None
+        self._loaded.add(user_id)
+        if raw:
+            self._saved[user_id] = raw
+            for k, v in json.loads(raw).items():
+                user_data.setdefault(k, v)
+
+    async def update_user_data(self, user_id: int, data: Dict[Any, Any]) -> None:
+        if user_id not in self._loaded:
+            return  # сохранённое не читали — пустой словарь не должен его затереть
+        raw = json.dumps(data, ensure_ascii=False, sort_keys=True, default=str) if data else None
+        if raw == self._saved.get(user_id):
+            return
+        if raw is None:
+            self._saved.pop(user_id, None)
+        else:
+            self._saved[user_id] = raw
+        self._dirty[user_id] = raw
+        self._schedule()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._loaded.add(user_id)
+        self._saved.pop(user_id, None)
+        self._dirty[user_id] = None
+        self._schedule()
+
+    async def flush(self) -> None:
+        if self._writer is not None:
+            await asyncio.gather(self._writer, return_exceptions=True)
+        await self._write_dirty()
+
+    def _schedule(self) -> None:
+        # PTB вызывает update_user_data для всех изменённых пользователей подряд —
+        # запись стартует после них и уносит всю пачку одной транзакцией
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.get_running_loop().create_task(self._write_dirty())
+
+    async def _write_dirty(self) -> None:
+        batch, self._dirty = self._dirty, {}
+        if not batch:
+            return
+        try:
+            await asyncio.to_thread(self._write, batch)
+        except Exception as e:
+            logger.warning("persistence: %s user_data rows not saved, will retry: %s", len(batch), e)
+            # более свежие изменения тех же пользователей важнее
+            self._dirty = {**batch, **self._dirty}
+
+    def _read(self, user_id: int) -> Optional[str]:
+        with self._lock:
+            row = self._db.execute("SELECT data FROM user_data WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def _write(self, batch: Dict[int, Optional[str]]) -> None:
+        now = datetime.utcnow().isoformat(timespec="seconds")
+        upserts = [(uid, raw, now) for uid, raw in batch.items() if raw is not None]
+        deletes = [(uid,) for uid, raw in batch.items() if raw is None]
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany(
+                    "INSERT INTO user_data (user_id, data, updated_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                    upserts,
+                )
+                self._db.executemany("DELETE FROM user_data WHERE user_id = ?", deletes)
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    # ---------- остальное не храним ----------
+
+    async def get_chat_data(self) -> Dict[int, Any]:
+        return {}
+
+    async def get_bot_data(self) -> Dict[Any, Any]:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> Dict:
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data) -> None:
+        pass
+
+    async def update_bot_data(self, data) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
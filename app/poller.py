@@ -0,0 +1,60 @@
+# app/poller.py
+"""Опрос таблицы orders: статусы, поменянные админами прямо в таблице.
+
+Раз в POLL_MINUTES задача JobQueue берёт свежий снимок orders и сравнивает
+его с предыдущим по order_id. Заказы со сменившимся статусом уходят в
+обычный путь уведомлений (notify_orders), а подписчики, которым этот
+статус уже отправляли, отсеиваются по last_sent_status. Первый опрос
+после старта только запоминает снимок.
+"""
+import logging
+from typing import Dict, List, Optional
+
+from telegram.ext import Application, ContextTypes
+
+from . import sheets_async as asheets
+from .config import POLL_MINUTES
+from .main import notify_orders
+
+logger = logging.getLogger(__name__)
+
+_JOB_NAME = "poll_orders"
+
+# {order_id в нижнем регистре: (order_id, status, updated_at)} с прошлого опроса
+_LAST: Optional[Dict[str, tuple]] = None
+
+
+def schedule(application: Application) -> None:
+    """Запланировать опрос (POLL_MINUTES <= 0 — выключен)."""
+    if POLL_MINUTES <= 0 or application.job_queue is None:
+        return
+    application.job_queue.run_repeating(_poll, interval=POLL_MINUTES * 60, first=10, name=_JOB_NAME)
+
+
+def diff(previous: Dict[str, tuple], current: Dict[str, tuple]) -> Dict[str, List[str]]:
+    """{новый статус: [order_id, ...]} — заказы, у которых статус сменился."""
+    changed: Dict[str, List[str]] = {}
+    for key, (order_id, status, _) in current.items():
+        old = previous.get(key)
+        if status and (old is None or old[1] != status):
+            changed.setdefault(status, []).append(order_id)
+    return changed
+
+
+async def _poll(context: ContextTypes.DEFAULT_TYPE) -> None:
+    global _LAST
+    try:
+        current = await asheets.get_order_statuses(fresh=True)
+    except Exception as e:
+        logger.warning("Orders poll failed: %s", e)
+        return
+    previous, _LAST = _LAST, current
+    if previous is None:
+        logger.info("Orders poll: baseline of %s orders", len(current))
+        return
+    for status, order_ids in diff(previous, current).items():
+        logger.info("Orders poll: %s orders -> %s", len(order_ids), status)
+        try:
+            await notify_orders(context.application, order_ids, status)
+        except Exception as e:
+            logger.warning("Orders poll: notify failed: %s", e)
@@ -0,0 +1,78 @@
+# app/ratelimit.py
+"""Token bucket и лимитер исходящих сообщений под лимиты Telegram.
+
+Telegram допускает ~30 сообщений в секунду на бота в целом и ~1 в секунду
+в один чат; при превышении приходит RetryAfter, после которого нужно
+замолчать на указанное время целиком.
+"""
+import asyncio
+import time
+from typing import Optional
+
+from cachetools import TTLCache
+
+
+class TokenBucket:
+    """rate токенов в секунду, не больше capacity про запас."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self) -> bool:
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def delay(self) -> float:
+        """Через сколько секунд появится токен."""
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    async def acquire(self) -> None:
+        while not self.try_acquire():
+            await asyncio.sleep(self.delay())
+
+
+class SendLimiter:
+    """Общий лимит бота + лимит на каждый чат + глобальная пауза после RetryAfter."""
+
+    def __init__(self, rate: float, chat_rate: float):
+        self.bucket = TokenBucket(rate)
+        self.chat_rate = chat_rate
+        self._chats: TTLCache = TTLCache(maxsize=10000, ttl=60)
+        self._paused_until = 0.0
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def wait(self, chat_id: int) -> None:
+        await self.wait_chat(chat_id)
+        await self.wait_global()
+
+    async def wait_chat(self, chat_id: int) -> None:
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = TokenBucket(self.chat_rate, 1)
+        await chat.acquire()
+
+    async def wait_global(self) -> None:
+        while True:
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            if self.bucket.try_acquire():
+                return
+            await asyncio.sleep(self.bucket.delay())
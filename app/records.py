@@ -0,0 +1,201 @@
+# app/records.py
+"""Строки листов как компактные записи со __slots__.
+
+Снимок листа хранит не словарь на каждую строку (с повтором всех ключей),
+а объект с полями-слотами; разбор идёт прямо из get_all_values по карте
+«колонка -> позиция в заголовке». Для совместимости записи читаются как
+dict: row["status"], row.get("status", ""), to_dict(). Колонки листа, которых
+нет в схеме, лежат в _extra.
+
+Записи, которые отдаёт sheets, — те же объекты, что в кэше: их не изменяют.
+"""
+from typing import Any, Callable, Dict, List, Optional
+
+_TRUE = ("true", "1", "yes", "y")
+
+
+def _flag(v: Any) -> bool:
+    if isinstance(v, bool):
+        return v
+    return str(v if v is not None else "").strip().lower() in _TRUE
+
+
+class Record:
+    """База записей: dict-подобный доступ к слотам и к лишним колонкам."""
+
+    __slots__ = ("_extra",)
+    FIELDS: tuple = ()
+
+    def __init__(self):
+        self._extra: Optional[Dict[str, Any]] = None
+
+    @classmethod
+    def reader(cls, header: List[str]) -> Callable[[List[str]], "Record"]:
+        """Функция «строка get_all_values -> запись» для данного заголовка."""
+        fields = cls.FIELDS
+        pos = {c: i for i, c in enumerate(header) if c}
+        take = [pos.get(c) for c in fields]
+        extra = [(c, i) for c, i in pos.items() if c not in fields]
+        width = len(header)
+        # обычный случай: колонки листа в порядке схемы — срез без перестановок
+        direct = take == list(range(len(fields)))
+        n = len(fields)
+
+        def read(raw: List[str]) -> "Record":
+            if len(raw) < width:
+                raw = list(raw) + [""] * (width - len(raw))
+            row = cls(*raw[:n]) if direct else cls(*["" if i is None else raw[i] for i in take])
+            if extra:
+                row._extra = {c: raw[i] for c, i in extra}
+            return row
+
+        return read
+
+    @classmethod
+    def from_dict(cls, values: Dict[str, Any]) -> "Record":
+        row = cls()
+        row.update(values)
+        return row
+
+    def get(self, column: str, default: Any = None) -> Any:
+        if column in self.FIELDS:
+            return getattr(self, column)
+        if self._extra is not None:
+            return self._extra.get(column, default)
+        return default
+
+    def __getitem__(self, column: str) -> Any:
+        if column in self.FIELDS:
+            return getattr(self, column)
+        if self._extra is not None and column in self._extra:
+            return self._extra[column]
+        raise KeyError(column)
+
+    def __setitem__(self, column: str, value: Any) -> None:
+        if column in self.FIELDS:
+            setattr(self, column, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[column] = value
+
+    def __contains__(self, column: str) -> bool:
+        return column in self.FIELDS or (self._extra is not None and column in self._extra)
+
+    def setdefault(self, column: str, default: Any = None) -> Any:
+        if column not in self:
+            self[column] = default
+        return self[column]
+
+    def update(self, values: Dict[str, Any]) -> None:
+        for c, v in values.items():
+            self[c] = v
+
+    def cell(self, column: str) -> str:
+        """Значение так, как оно лежит в ячейке листа."""
+        v = self.get(column, "")
+        if isinstance(v, bool):
+            return "TRUE" if v else "FALSE"
+        return str(v if v is not None else "")
+
+    def to_dict(self) -> Dict[str, Any]:
+        d = {c: getattr(self, c) for c in self.FIELDS}
+        if self._extra:
+            d.update(self._extra)
+        return d
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+
+class Order(Record):
+    __slots__ = ("order_id", "client_name", "phone", "origin", "status", "note", "country", "updated_at")
+    FIELDS = __slots__
+
+    def __init__(self, order_id="", client_name="", phone="", origin="", status="", note="", country="", updated_at=""):
+        self._extra = None
+        self.order_id = order_id
+        self.client_name = client_name
+        self.phone = phone
+        self.origin = origin
+        self.status = status
+        self.note = note
+        self.country = country
+        self.updated_at = updated_at
+
+
+class Address(Record):
+    __slots__ = ("user_id", "username", "full_name", "phone", "city", "address", "postcode", "created_at", "updated_at")
+    FIELDS = __slots__
+
+    def __init__(self, user_id="", username="", full_name="", phone="", city="", address="", postcode="",
+                 created_at="", updated_at=""):
+        self._extra = None
+        self.user_id = user_id
+        self.username = username
+        self.full_name = full_name
+        self.phone = phone
+        self.city = city
+        self.address = address
+        self.postcode = postcode
+        self.created_at = created_at
+        self.updated_at = updated_at
+
+
+class Subscription(Record):
+    __slots__ = ("user_id", "order_id", "last_sent_status", "created_at", "updated_at")
+    FIELDS = __slots__
+
+    def __init__(self, user_id="", order_id="", last_sent_status="", created_at="", updated_at=""):
+        self._extra = None
+        self.user_id = user_id
+        self.order_id = order_id
+        self.last_sent_status = last_sent_status
+        self.created_at = created_at
+        self.updated_at = updated_at
+
+
+class Participant(Record):
+    """username — без @ и в нижнем регистре, paid — bool (в листе TRUE/FALSE)."""
+
+    __slots__ = ("order_id", "username", "paid", "qty", "created_at", "updated_at")
+    FIELDS = __slots__
+
+    def __init__(self, order_id="", username="", paid=False, qty="", created_at="", updated_at=""):
+        self._extra = None
+        self.order_id = order_id
+        self.username = str(username or "").strip().lstrip("@").lower()
+        self.paid = _flag(paid)
+        self.qty = qty
+        self.created_at = created_at
+        self.updated_at = updated_at
+
+    def __setitem__(self, column: str, value: Any) -> None:
+        if column == "paid":
+            value = _flag(value)
+        elif column == "username":
+            value = str(value or "").strip().lstrip("@").lower()
+        super().__setitem__(column, value)
+
+
+class User(Record):
+    """Справочник username -> user_id (app/directory.py); username — без @, в нижнем регистре."""
+
+    __slots__ = ("user_id", "username", "last_seen")
+    FIELDS = __slots__
+
+    def __init__(self, user_id="", username="", last_seen=""):
+        self._extra = None
+        self.user_id = user_id
+        self.username = username
+        self.last_seen = last_seen
+
+
+# лист -> класс записи; порядок слотов задаёт колонки новых листов (HEADERS)
+RECORDS: Dict[str, type] = {
+    "orders": Order,
+    "addresses": Address,
+    "subscriptions": Subscription,
+    "participants": Participant,
+    "users": User,
+}
@@ -1,12 +1,36 @@
 # app/sheets.py
 import os
 import json
+import time
+import logging
+import threading
 from datetime import datetime
 from typing import List, Dict, Any, Optional
 
-import pandas as pd
 import gspread
+from cachetools import TTLCache
+from google.auth.transport.requests import AuthorizedSession
 from google.oauth2.service_account import Credentials
+from requests.adapters import HTTPAdapter
+
+from .config import (
+    SHEETS_WS_CACHE_TTL,
+    SHEETS_HTTP_POOL_SIZE,
+    SHEETS_CACHE_TTL,
+    SHEETS_VIEW_TTL,
+    SHEETS_PROBE_TTL,
+    SHEETS_NEGATIVE_TTL,
+    SHEETS_TIMEOUT,
+    SHEETS_WRITE_DELAY,
+    SHEETS_JOURNAL_PATH,
+    STORAGE_BACKEND,
+    SQLITE_PATH,
+    SYNC_SECONDS,
+)
+from .records import Record, Order, Address, Subscription, Participant, User, RECORDS
+from .order_index import OrderIdIndex
+
+logger = logging.getLogger(__name__)
 
 # -------------------------------------------------
 #  Google Sheets client
@@ -17,62 +41,824 @@ SCOPE = [
     "https://www.googleapis.com/auth/drive",
 ]
 
+# колонки листов — поля записей из records.py
+HEADERS: Dict[str, List[str]] = {title: list(cls.FIELDS) for title, cls in RECORDS.items()}
+
+# Клиент, таблица и хэндлы листов живут весь процесс: авторизация и open_by_key
+# выполняются один раз, а не на каждый вызов.
+_LOCK = threading.RLock()
+_CLIENT: Optional[gspread.Client] = None
+_SPREADSHEET: Optional[gspread.Spreadsheet] = None
+_WORKSHEETS: TTLCache = TTLCache(maxsize=32, ttl=SHEETS_WS_CACHE_TTL)
+
 def _now() -> str:
     return datetime.utcnow().isoformat(timespec="seconds")
 
-def _client():
+def _credentials() -> Credentials:
     creds_json = os.getenv("GOOGLE_CREDENTIALS_JSON")
     creds_file = os.getenv("GOOGLE_CREDENTIALS_FILE")
     if creds_json:
         info = json.loads(creds_json)
-        creds = Credentials.from_service_account_info(info, scopes=SCOPE)
-    elif creds_file:
-        creds = Credentials.from_service_account_file(creds_file, scopes=SCOPE)
-    else:
-        raise RuntimeError("GOOGLE_CREDENTIALS_JSON or GOOGLE_CREDENTIALS_FILE is not set")
-    return gspread.authorize(creds)
-
-def _sheet():
-    sid = os.getenv("GOOGLE_SHEETS_ID")
-    if not sid:
-        raise RuntimeError("GOOGLE_SHEETS_ID is not set")
-    return _client().open_by_key(sid)
+        return Credentials.from_service_account_info(info, scopes=SCOPE)
+    if creds_file:
+        return Credentials.from_service_account_file(creds_file, scopes=SCOPE)
+    raise RuntimeError("GOOGLE_CREDENTIALS_JSON or GOOGLE_CREDENTIALS_FILE is not set")
+
+def _session(creds: Credentials) -> AuthorizedSession:
+    """HTTP-сессия с пулом keep-alive соединений.
+
+    AuthorizedSession сам обновляет access token, когда тот истекает
+    (или когда API ответил 401), так что сессию можно держать весь процесс.
+    """
+    session = AuthorizedSession(creds)
+    adapter = HTTPAdapter(pool_connections=SHEETS_HTTP_POOL_SIZE, pool_maxsize=SHEETS_HTTP_POOL_SIZE)
+    session.mount("https://", adapter)
+    return session
+
+def _client() -> gspread.Client:
+    global _CLIENT
+    with _LOCK:
+        if _CLIENT is None:
+            creds = _credentials()
+            _CLIENT = gspread.authorize(creds, session=_session(creds))
+            # поток пула sheets_async не должен висеть на сокете дольше таймаута вызова
+            _CLIENT.set_timeout(SHEETS_TIMEOUT)
+        return _CLIENT
+
+def _sheet() -> gspread.Spreadsheet:
+    global _SPREADSHEET
+    with _LOCK:
+        if _SPREADSHEET is None:
+            sid = os.getenv("GOOGLE_SHEETS_ID")
+            if not sid:
+                raise RuntimeError("GOOGLE_SHEETS_ID is not set")
+            _SPREADSHEET = _client().open_by_key(sid)
+        return _SPREADSHEET
+
+def reset_client() -> None:
+    """Сбросить клиент, таблицу и кэш листов (например, после смены ключа)."""
+    global _CLIENT, _SPREADSHEET
+    with _LOCK:
+        _CLIENT = None
+        _SPREADSHEET = None
+        _WORKSHEETS.clear()
 
 def get_worksheet(title: str):
-    """Open a worksheet by title, create (with header) if doesn't exist."""
-    sh = _sheet()
-    try:
-        return sh.worksheet(title)
-    except gspread.WorksheetNotFound:
-        ws = sh.add_worksheet(title=title, rows=1000, cols=20)
-        if title == "orders":
-            ws.append_row(["order_id", "client_name", "phone", "origin", "status", "note", "country", "updated_at"])
-        elif title == "addresses":
-            ws.append_row(["user_id", "username", "full_name", "phone", "city", "address", "postcode", "created_at", "updated_at"])
-        elif title == "subscriptions":
-            ws.append_row(["user_id", "order_id", "last_sent_status", "created_at", "updated_at"])
-        elif title == "participants":
-            ws.append_row(["order_id", "username", "paid", "qty", "created_at", "updated_at"])
+    """Open a worksheet by title, create (with header) if doesn't exist.
+
+    Хэндлы кэшируются на SHEETS_WS_CACHE_TTL секунд; при промахе метаданные
+    всех листов подтягиваются одним запросом.
+    """
+    with _LOCK:
+        ws = _WORKSHEETS.get(title)
+        if ws is not None:
+            return ws
+        sh = _sheet()
+        for w in sh.worksheets():
+            _WORKSHEETS[w.title] = w
+        ws = _WORKSHEETS.get(title)
+        if ws is None:
+            ws = sh.add_worksheet(title=title, rows=1000, cols=20)
+            if title in HEADERS:
+                ws.append_row(HEADERS[title])
+            _WORKSHEETS[title] = ws
         return ws
 
+# -------------------------------------------------
+#  Кэш таблиц (read-through, TTL)
+# -------------------------------------------------
+
+# Вторичные индексы снимка: колонка -> нормализованное значение -> позиции строк.
+INDEXED: Dict[str, tuple] = {
+    "orders": (),
+    "addresses": ("username",),
+    "subscriptions": ("user_id", "order_id"),
+    "participants": ("order_id", "username"),
+    "users": ("username",),
+}
+
+class _Table:
+    """Снимок листа: заголовок и строки-записи (Order, Address, ... из records.py).
+
+    by_key — индекс по ключу строки (KEYS), by — вторичные индексы (INDEXED);
+    оба хранят позиции в rows и поддерживаются методами update/append/delete,
+    так что поиск не зависит от размера листа.
+    """
+
+    __slots__ = ("title", "header", "rows", "by_key", "by")
+
+    def __init__(self, title: str, values: List[List[str]]):
+        header = [str(h).strip() for h in values[0]] if values else []
+        self.title = title
+        self.header = header
+        read = RECORDS.get(title, Record).reader(header)
+        self.rows: List[Record] = [read(raw) for raw in values[1:]]
+        self._reindex()
+
+    def _reindex(self) -> None:
+        self.by_key: Dict[tuple, List[int]] = {}
+        self.by: Dict[str, Dict[str, List[int]]] = {c: {} for c in INDEXED.get(self.title, ())}
+        for i, row in enumerate(self.rows):
+            self._index(i, row)
+
+    def _index(self, i: int, row: Record) -> None:
+        k = _row_key(self.title, row)
+        if any(k):
+            self.by_key.setdefault(k, []).append(i)
+        for c, idx in self.by.items():
+            v = _norm(row.get(c, ""))
+            if v:
+                idx.setdefault(v, []).append(i)
+
+    def _unindex(self, i: int, row: Record) -> None:
+        k = _row_key(self.title, row)
+        if i in self.by_key.get(k, ()):
+            self.by_key[k].remove(i)
+            if not self.by_key[k]:
+                del self.by_key[k]
+        for c, idx in self.by.items():
+            v = _norm(row.get(c, ""))
+            if i in idx.get(v, ()):
+                idx[v].remove(i)
+                if not idx[v]:
+                    del idx[v]
+
+    def find(self, key: tuple) -> List[Record]:
+        """Строки с данным ключом (в порядке листа)."""
+        return [self.rows[i] for i in sorted(self.by_key.get(key, ()))]
+
+    def lookup(self, column: str, value: Any) -> List[Record]:
+        """Строки, где column == value (по вторичному индексу, в порядке листа)."""
+        return [self.rows[i] for i in sorted(self.by[column].get(_norm(value), ()))]
+
+    def update(self, i: int, changes: Dict[str, Any]) -> None:
+        row = self.rows[i]
+        reindex = any(c in KEYS.get(self.title, ()) or c in self.by for c in changes)
+        if reindex:
+            self._unindex(i, row)
+        row.update({c: str(v) for c, v in changes.items()})
+        if reindex:
+            self._index(i, row)
+
+    def append(self, values: Dict[str, Any]) -> None:
+        row = RECORDS.get(self.title, Record).from_dict(values)
+        self.rows.append(row)
+        self._index(len(self.rows) - 1, row)
+
+    def delete(self, idxs) -> None:
+        # позиции сдвигаются — индексы проще пересобрать
+        doomed = set(idxs)
+        if doomed:
+            self.rows = [row for i, row in enumerate(self.rows) if i not in doomed]
+            self._reindex()
+
+# Один снимок на лист; писатели модуля патчат его вместе с самим листом.
+_TABLES: TTLCache = TTLCache(maxsize=8, ttl=SHEETS_CACHE_TTL)
+_LOAD_LOCKS: Dict[str, threading.Lock] = {}
+# Готовые списки участников по order_id для листания карточки (pp:page/pp:toggle).
+# Живут дольше снимка и сбрасываются любой правкой participants или новым снимком.
+_VIEWS: TTLCache = TTLCache(maxsize=256, ttl=SHEETS_VIEW_TTL)
+# Ключи order_id, которых нет в orders: опечатки и спам не вызывают
+# перечитывание листа, когда снимок истёк. Ключ снимается, как только заказ
+# появляется (add_order или новый снимок, где он есть).
+_MISSING: TTLCache = TTLCache(maxsize=10000, ttl=SHEETS_NEGATIVE_TTL)
+_WRITE_LOCKS: Dict[str, threading.Lock] = {}
+
+def _load(title: str) -> _Table:
+    """Прочитать лист из хранилища как есть, без кэша и без отложенных изменений."""
+    if _STORE is not None:
+        return _Table(title, _STORE.values(title))
+    return _load_sheet(title)
+
+def _load_sheet(title: str) -> _Table:
+    version = _probe()  # до скачивания: снимок не старше этой версии
+    t = _Table(title, get_worksheet(title).get_all_values())
+    with _LOCK:
+        _VERSIONS[title] = version
+    return t
+
+def _store(t: _Table) -> None:
+    """Положить снимок в кэш, наложив ещё не записанные изменения."""
+    with _LOCK:
+        # сначала то, что пишется прямо сейчас, поверх — то, что ещё ждёт
+        for m in _INFLIGHT.get(t.title, ()):
+            _patch_rows(t, m)
+        for m in _PENDING.get(t.title, {}).values():
+            _patch_rows(t, m)
+        _TABLES[t.title] = t
+        if _STORE is None:
+            _LAST[t.title] = t
+        if t.title == "participants":
+            _VIEWS.clear()
+        if t.title == "orders" and _MISSING:
+            for key in [k for k in _MISSING if k in t.by_key]:
+                _MISSING.pop(key, None)
+
+def _table(title: str, fresh: bool = False) -> _Table:
+    with _LOCK:
+        t = None if fresh else _TABLES.get(title)
+        if t is not None:
+            return t
+        load_lock = _LOAD_LOCKS.setdefault(title, threading.Lock())
+    # одновременные промахи по одному листу ждут одну загрузку
+    with load_lock:
+        with _LOCK:
+            t = None if fresh else _TABLES.get(title)
+        if t is None:
+            t = _unchanged(title, force=fresh) or _load(title)
+            _store(t)
+        return t
+
+def _tables(*titles: str, fresh: bool = False) -> List[_Table]:
+    """Снимки нескольких листов; недостающие читаются одним values_batch_get."""
+    with _LOCK:
+        found = {title: None if fresh else _TABLES.get(title) for title in titles}
+    for title in [title for title, t in found.items() if t is None]:
+        found[title] = _unchanged(title, force=fresh)
+        if found[title] is not None:
+            _store(found[title])
+    missing = [title for title, t in found.items() if t is None]
+    if len(missing) > 1 and _STORE is None:
+        for title in missing:
+            get_worksheet(title)  # создать лист, если его ещё нет
+        version = _probe()
+        resp = _sheet().values_batch_get([gspread.utils.absolute_range_name(title) for title in missing])
+        for title, vr in zip(missing, resp.get("valueRanges", [])):
+            found[title] = _Table(title, vr.get("values", []))
+            with _LOCK:
+                _VERSIONS[title] = version
+            _store(found[title])
+    return [found[title] or _table(title, fresh) for title in titles]
+
+def _records(title: str) -> List[Record]:
+    return _table(title).rows
+
+def to_dataframe(title: str):
+    """Лист как pandas.DataFrame — для тяжёлых отчётов.
+
+    pandas не нужен боту для работы и импортируется только здесь
+    (pip install pandas, если нужен этот помощник).
+    """
+    import pandas as pd
+    t = _table(title)
+    return pd.DataFrame([[row.cell(c) for c in t.header] for row in t.rows], columns=t.header)
+
+def invalidate_cache(title: Optional[str] = None) -> None:
+    """Сбросить снимок листа (или всех листов, если title не указан)."""
+    with _LOCK:
+        if title is None:
+            _TABLES.clear()
+            _LAST.clear()
+        else:
+            _TABLES.pop(title, None)
+            _LAST.pop(title, None)
+        if title in (None, "participants"):
+            _VIEWS.clear()
+        if title in (None, "orders"):
+            _MISSING.clear()
+
+# -------------------------------------------------
+#  Проверка свежести (modifiedTime таблицы)
+# -------------------------------------------------
+
+# Когда TTL снимка истёк, сначала спрашиваем у Drive время последнего
+# изменения таблицы (крошечный запрос) и скачиваем лист, только если оно
+# поменялось с тех пор, как снимок был прочитан. Время общее на всю таблицу,
+# поэтому любая своя запись делает версии всех снимков неизвестными.
+# Только для чтений: запись (_write_sheet) всегда перечитывает лист.
+_PROBE: Dict[str, Any] = {"at": 0.0, "version": None}
+_VERSIONS: Dict[str, Optional[str]] = {}     # title -> версия таблицы, при которой читали снимок
+_LAST: Dict[str, _Table] = {}                # title -> последний снимок (живёт дольше TTL)
+
+def _probe(force: bool = False) -> Optional[str]:
+    """modifiedTime таблицы, не чаще раза в SHEETS_PROBE_TTL секунд; None — узнать не удалось."""
+    with _LOCK:
+        if not force and time.monotonic() - _PROBE["at"] < SHEETS_PROBE_TTL:
+            return _PROBE["version"]
+    try:
+        version = _sheet().get_lastUpdateTime()
+    except Exception as e:
+        logger.warning("Sheets freshness probe failed: %s", e)
+        version = None
+    with _LOCK:
+        _PROBE.update(at=time.monotonic(), version=version)
+    return version
+
+def _unchanged(title: str, force: bool = False) -> Optional[_Table]:
+    """Последний снимок листа, если таблица не менялась с момента его чтения."""
+    if _STORE is not None:
+        return None
+    with _LOCK:
+        t, known = _LAST.get(title), _VERSIONS.get(title)
+    if t is None or known is None:
+        return None
+    return t if _probe(force) == known else None
+
+def _own_write() -> None:
+    """Мы сами поменяли таблицу: версии снимков больше ни о чём не говорят."""
+    with _LOCK:
+        _VERSIONS.clear()
+        _PULLED.clear()
+        _PROBE["at"] = 0.0
+
+# -------------------------------------------------
+#  Точечная запись (patch вместо clear + rewrite)
+# -------------------------------------------------
+
+# Ключ строки в каждом листе (значения сравниваются через _norm).
+KEYS: Dict[str, tuple] = {
+    "orders": ("order_id",),
+    "addresses": ("user_id",),
+    "subscriptions": ("user_id", "order_id"),
+    "participants": ("order_id", "username"),
+    "users": ("user_id",),
+}
+
+def _norm(v: Any) -> str:
+    return str(v if v is not None else "").strip().lower()
+
+def _key(*values: Any) -> tuple:
+    return tuple(_norm(v) for v in values)
+
+def _row_key(title: str, row: Dict[str, Any]) -> tuple:
+    return tuple(_norm(row.get(c, "")) for c in KEYS[title])
+
+class _Mutation:
+    """Изменение строк листа с данным ключом.
+
+    changes — новые значения ячеек для найденных строк;
+    insert — полная строка, которую нужно добавить, если ключ не найден;
+    delete — удалить все строки с этим ключом.
+    """
+
+    __slots__ = ("key", "changes", "insert", "delete")
+
+    def __init__(self, key: tuple, changes: Optional[Dict[str, Any]] = None,
+                 insert: Optional[Dict[str, Any]] = None, delete: bool = False):
+        self.key = key
+        self.changes = changes or {}
+        self.insert = insert
+        self.delete = delete
+
+    def merge(self, newer: "_Mutation") -> "_Mutation":
+        """Склеить с более поздним изменением того же ключа."""
+        if newer.delete or self.delete:
+            return newer
+        insert = self.insert or newer.insert
+        if insert is not None:
+            insert = dict(insert, **newer.changes)
+        return _Mutation(self.key, dict(self.changes, **newer.changes), insert=insert)
+
+def _write_lock(title: str) -> threading.Lock:
+    with _LOCK:
+        return _WRITE_LOCKS.setdefault(title, threading.Lock())
+
+def _targets(t: _Table, m: _Mutation) -> bool:
+    """Найдётся ли (или добавится) строка для мутации — то же, что вернёт _patch_rows."""
+    return bool(t.by_key.get(m.key)) or (m.insert is not None and not m.delete)
+
+def _patch_rows(t: _Table, m: _Mutation) -> bool:
+    """Применить мутацию к снимку в памяти (без запросов к API)."""
+    hits = list(t.by_key.get(m.key, ()))
+    if t.title == "participants":
+        _VIEWS.pop(m.key[0], None)
+    if m.delete:
+        t.delete(hits)
+    elif hits:
+        for i in hits:
+            t.update(i, m.changes)
+    elif m.insert is not None:
+        t.append({c: str(m.insert.get(c, "")) for c in (t.header or HEADERS.get(t.title, list(m.insert)))})
+    return bool(hits) or (m.insert is not None and not m.delete)
+
+def _runs(cols: List[int]) -> List[List[int]]:
+    """[1, 2, 3, 6] -> [[1, 2, 3], [6]]: смежные колонки пишем одним диапазоном."""
+    runs: List[List[int]] = []
+    for c in sorted(cols):
+        if runs and c == runs[-1][-1] + 1:
+            runs[-1].append(c)
+        else:
+            runs.append([c])
+    return runs
+
+def _apply(title: str, mutations: List[_Mutation]) -> List[bool]:
+    """Применить изменения к листу минимальным числом запросов.
+
+    Сначала забираются отложенные изменения этого листа (write-behind),
+    затем все строки ищутся по ключу в свежем снимке; изменённые ячейки
+    уходят одним values_batch_update, новые строки — одним append_rows,
+    удаления — delete_rows по смежным блокам. Снимок в кэше патчится на месте.
+    Возвращает для каждой переданной мутации, нашлась ли (или добавилась) строка.
+    """
+    with _write_lock(title):
+        with _LOCK:
+            queued = list(_PENDING.pop(title, {}).values())
+            if queued:
+                _INFLIGHT[title] = queued
+        if not queued and not mutations:
+            return []
+        try:
+            results = _write(title, queued + list(mutations))[len(queued):]
+        except Exception:
+            # отложенные изменения не теряем: вернём их в очередь под более свежими
+            with _LOCK:
+                _INFLIGHT.pop(title, None)
+                pending = _PENDING.setdefault(title, {})
+                for m in queued:
+                    pending[m.key] = m.merge(pending[m.key]) if m.key in pending else m
+            raise
+        if queued:
+            with _LOCK:
+                _INFLIGHT.pop(title, None)
+            _journal_compact()
+        return results
+
+def _write(title: str, mutations: List[_Mutation]) -> List[bool]:
+    if _STORE is not None:
+        results = _STORE.write(title, mutations)
+        with _LOCK:
+            t = _TABLES.get(title)
+            if t is not None:
+                for m in mutations:
+                    _patch_rows(t, m)
+        return results
+    results, t = _write_sheet(title, mutations)
+    _store(t)
+    return results
+
+def _write_sheet(title: str, mutations: List[_Mutation]):
+    """Записать мутации в Google-лист. Вернёт (результаты, свежий снимок листа с патчем)."""
+    ws = get_worksheet(title)
+    # позиции строк — только из свежего чтения: modifiedTime может отставать от
+    # ручной сортировки/вставки, и запись по кэшу легла бы не на те строки
+    t = _load_sheet(title)
+    header = list(t.header) or list(HEADERS.get(title, []))
+
+    positions = t.by_key
+    cells: Dict[int, Dict[str, Any]] = {}      # индекс строки -> {колонка: значение}
+    new_rows: Dict[tuple, Dict[str, Any]] = {}
+    doomed: set = set()
+    results: List[bool] = []
+    for m in mutations:
+        idxs = positions.get(m.key, [])
+        if m.delete:
+            doomed.update(idxs)
+            queued_insert = new_rows.pop(m.key, None)
+            results.append(bool(idxs) or queued_insert is not None)
+        elif idxs:
+            for i in idxs:
+                # ячейки, где в листе уже то же значение, не переписываем
+                changes = {c: v for c, v in m.changes.items() if c not in t.rows[i] or t.rows[i].cell(c) != str(v)}
+                if changes:
+                    cells.setdefault(i, {}).update(changes)
+            results.append(True)
+        elif m.key in new_rows:
+            new_rows[m.key].update(m.changes)
+            results.append(True)
+        elif m.insert is not None:
+            new_rows[m.key] = {c: "" for c in header}
+            new_rows[m.key].update(m.insert)
+            results.append(True)
+        else:
+            results.append(False)
+    for i in doomed:
+        cells.pop(i, None)
+    used = {c for changes in list(cells.values()) + list(new_rows.values()) for c in changes}
+    for c in HEADERS.get(title, []) + sorted(used):
+        if c in used and c not in header:
+            header.append(c)
+
+    data = []
+    if header != t.header:
+        data.append({"range": gspread.utils.absolute_range_name(title, "A1"), "values": [header]})
+    for i, changes in sorted(cells.items()):
+        for run in _runs([header.index(c) + 1 for c in changes]):
+            a1 = "{}:{}".format(
+                gspread.utils.rowcol_to_a1(i + 2, run[0]),
+                gspread.utils.rowcol_to_a1(i + 2, run[-1]),
+            )
+            values = [changes[header[c - 1]] for c in run]
+            data.append({"range": gspread.utils.absolute_range_name(title, a1), "values": [values]})
+    try:
+        if data:
+            _sheet().values_batch_update(body={"valueInputOption": "RAW", "data": data})
+        if new_rows:
+            ws.append_rows(
+                [[row.get(c, "") for c in header] for row in new_rows.values()],
+                value_input_option="RAW",
+                table_range="A1",
+            )
+        for block in reversed(_runs([i + 2 for i in doomed])):
+            ws.delete_rows(block[0], block[-1])
+    except Exception:
+        # лист мог записаться частично — пусть следующее чтение скачает его заново
+        invalidate_cache(title)
+        raise
+    finally:
+        if data or new_rows or doomed:
+            _own_write()
+
+    # тот же патч — в снимок, чтобы следующее чтение не ходило в API
+    t.header = header
+    for row in t.rows:
+        for c in header:
+            row.setdefault(c, "")
+    for i, changes in cells.items():
+        t.update(i, changes)
+    for row in new_rows.values():
+        t.append({c: str(row.get(c, "")) for c in header})
+    t.delete(doomed)
+    return results, t
+
+# -------------------------------------------------
+#  Отложенная запись (write-behind)
+# -------------------------------------------------
+
+# title -> key -> склеенная мутация; пишется пачкой через SHEETS_WRITE_DELAY секунд.
+_PENDING: Dict[str, Dict[tuple, _Mutation]] = {}
+_INFLIGHT: Dict[str, List[_Mutation]] = {}      # забраны из очереди, запись ещё не подтверждена
+_PENDING_READY = threading.Condition(_LOCK)
+_FLUSHER: Optional[threading.Thread] = None
+
+def _enqueue(title: str, m: _Mutation) -> bool:
+    """Отложить изменение строки; повторные изменения того же ключа склеиваются.
+
+    Снимок в кэше патчится сразу, так что чтения видят новое значение ещё до
+    записи в таблицу. Возвращает, есть ли такая строка (или будет добавлена).
+    """
+    if SHEETS_WRITE_DELAY <= 0 or _STORE is not None:
+        # в SQLite-режиме локальная запись и так дешёвая и надёжная
+        return _apply(title, [m])[0]
+    t = _table(title)
+    with _JOURNAL_LOCK:
+        with _LOCK:
+            found = _targets(_TABLES.get(title) or t, m)
+        if not found:
+            return False
+        _journal_append(title, m)
+        # патч снимка и постановка в очередь — под одним _LOCK: перезагрузка
+        # листа между ними закэшировала бы старое значение до самой записи
+        with _LOCK:
+            # снимок могли перезагрузить, пока мы его получали — патчим актуальный
+            _patch_rows(_TABLES.get(title) or t, m)
+            _queue(title, m)
+    return True
+
+def _queue(title: str, m: _Mutation) -> None:
+    with _LOCK:
+        pending = _PENDING.setdefault(title, {})
+        pending[m.key] = pending[m.key].merge(m) if m.key in pending else m
+        _start_flusher()
+        _PENDING_READY.notify()
+
+def _start_flusher() -> None:
+    global _FLUSHER
+    if _FLUSHER is None or not _FLUSHER.is_alive():
+        _FLUSHER = threading.Thread(target=_flush_loop, name="sheets-flush", daemon=True)
+        _FLUSHER.start()
+
+def _flush_loop() -> None:
+    while True:
+        with _PENDING_READY:
+            while not _PENDING:
+                _PENDING_READY.wait()
+        # окно склейки: даём пачке изменений набраться
+        time.sleep(SHEETS_WRITE_DELAY)
+        try:
+            flush()
+        except Exception as e:
+            logger.warning("sheets write-behind flush failed, will retry: %s", e)
+            time.sleep(max(SHEETS_WRITE_DELAY, 5))
+
+def flush() -> int:
+    """Записать все отложенные изменения (по одному пакету на лист). Вернёт число строк."""
+    if _STORE is not None:
+        return sum(_push(title) for title in HEADERS)
+    with _LOCK:
+        titles = [t for t, pending in _PENDING.items() if pending]
+        count = sum(len(_PENDING[t]) for t in titles)
+    for title in titles:
+        _apply(title, [])
+    return count
+
+# -------------------------------------------------
+#  Журнал отложенных записей
+# -------------------------------------------------
+
+# Каждое отложенное изменение сначала дописывается (с fsync) в локальный
+# JSONL-журнал и только потом встаёт в очередь. После подтверждённой записи
+# в таблицу журнал сжимается до того, что ещё не записано, а при старте
+# процесса replay_journal() возвращает неподтверждённые изменения в очередь.
+_JOURNAL_LOCK = threading.Lock()
+_JOURNAL = None
+
+def _journal_file():
+    global _JOURNAL
+    if _JOURNAL is None:
+        os.makedirs(os.path.dirname(os.path.abspath(SHEETS_JOURNAL_PATH)), exist_ok=True)
+        _JOURNAL = open(SHEETS_JOURNAL_PATH, "a", encoding="utf-8")
+    return _JOURNAL
+
+def _journal_line(title: str, m: _Mutation) -> str:
+    return json.dumps(
+        {"title": title, "key": list(m.key), "changes": m.changes, "insert": m.insert},
+        ensure_ascii=False, default=str,
+    ) + "\n"
+
+def _journal_append(title: str, m: _Mutation) -> None:
+    if not SHEETS_JOURNAL_PATH:
+        return
+    f = _journal_file()
+    f.write(_journal_line(title, m))
+    f.flush()
+    os.fsync(f.fileno())
+
+def _journal_compact() -> None:
+    """Оставить в журнале только изменения, которые ещё не записаны в таблицу."""
+    global _JOURNAL
+    if not SHEETS_JOURNAL_PATH:
+        return
+    with _JOURNAL_LOCK:
+        with _LOCK:
+            left = [(title, m) for title, pending in _PENDING.items() for m in pending.values()]
+            left += [(title, m) for title, ms in _INFLIGHT.items() for m in ms]
+        if _JOURNAL is not None:
+            _JOURNAL.close()
+            _JOURNAL = None
+        tmp = SHEETS_JOURNAL_PATH + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.writelines(_journal_line(title, m) for title, m in left)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, SHEETS_JOURNAL_PATH)
+        dir_fd = os.open(os.path.dirname(os.path.abspath(SHEETS_JOURNAL_PATH)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+def replay_journal() -> int:
+    """Вернуть в очередь изменения, не записанные до падения/рестарта. Вернёт их число."""
+    if not SHEETS_JOURNAL_PATH or not os.path.exists(SHEETS_JOURNAL_PATH):
+        return 0
+    count = 0
+    with _JOURNAL_LOCK:
+        with open(SHEETS_JOURNAL_PATH, encoding="utf-8") as f:
+            for n, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    rec = json.loads(line)
+                    m = _Mutation(tuple(rec["key"]), rec.get("changes"), insert=rec.get("insert"))
+                except (ValueError, KeyError) as e:
+                    # недописанная последняя строка после падения — пропускаем
+                    logger.warning("sheets journal: skip broken line %s: %s", n, e)
+                    continue
+                if _STORE is not None:
+                    _apply(rec["title"], [m])
+                else:
+                    _queue(rec["title"], m)
+                count += 1
+    for title in list(_PENDING):
+        invalidate_cache(title)
+    if _STORE is not None and count:
+        _journal_compact()
+    return count
+
+# -------------------------------------------------
+#  SQLite как основное хранилище, Google Sheets — зеркало
+# -------------------------------------------------
+
+# При STORAGE_BACKEND=sqlite снимки читаются и мутации пишутся в локальную
+# базу, а фоновый поток раз в SYNC_SECONDS отправляет изменённые строки в
+# таблицу и забирает обратно то, что админы поправили в ней руками.
+_STORE = None
+if STORAGE_BACKEND == "sqlite":
+    from .sqlite_store import SqliteStore
+    _STORE = SqliteStore(SQLITE_PATH, HEADERS, _row_key)
+
+_SYNC_LOCK = threading.Lock()
+_SYNCER: Optional[threading.Thread] = None
+_PULLED: Dict[str, Optional[str]] = {}       # title -> версия таблицы при последнем pull
+
+def _push(title: str) -> int:
+    """Отправить в лист локальные изменения. Вернёт число отправленных строк."""
+    with _SYNC_LOCK:
+        upserts, deletes = _STORE.dirty(title)
+        if not upserts and not deletes:
+            return 0
+        mutations = [_Mutation(key, row, insert=row) for key, _, row in upserts]
+        mutations += [_Mutation(key, delete=True) for key, _ in deletes]
+        _write_sheet(title, mutations)
+        _STORE.mark_synced(title, [(key, seq) for key, seq, _ in upserts] + deletes)
+        return len(mutations)
+
+def _pull(title: str) -> int:
+    """Забрать правки из листа в локальную базу. Вернёт число изменённых строк."""
+    with _SYNC_LOCK:
+        version = _probe(force=True)
+        if version is not None and _PULLED.get(title) == version:
+            return 0  # таблицу никто не трогал — качать нечего
+        changed = _STORE.merge_remote(title, get_worksheet(title).get_all_values())
+        with _LOCK:
+            _PULLED[title] = version
+    if changed:
+        invalidate_cache(title)
+    return changed
+
+def sync_mirror() -> None:
+    """Один цикл синхронизации SQLite <-> Google Sheets (в режиме sheets — ничего)."""
+    if _STORE is None:
+        return
+    for title in HEADERS:
+        _push(title)
+        _pull(title)
+
+def start_sync() -> None:
+    """Запустить фоновую синхронизацию; при пустой базе сначала скачать таблицу целиком."""
+    global _SYNCER
+    if _STORE is None or (_SYNCER is not None and _SYNCER.is_alive()):
+        return
+    if _STORE.is_empty():
+        sync_mirror()
+    _SYNCER = threading.Thread(target=_sync_loop, name="sheets-sync", daemon=True)
+    _SYNCER.start()
+
+def _sync_loop() -> None:
+    while True:
+        time.sleep(SYNC_SECONDS)
+        try:
+            sync_mirror()
+        except Exception as e:
+            logger.warning("sqlite <-> sheets sync failed, will retry: %s", e)
+
 # -------------------------------------------------
 #  ORDERS
 # -------------------------------------------------
 
-def _ensure_orders_cols(df: pd.DataFrame) -> pd.DataFrame:
-    cols = ["order_id", "client_name", "phone", "origin", "status", "note", "country", "updated_at"]
-    for c in cols:
-        if c not in df.columns:
-            df[c] = ""
-    return df[cols]
+# Читатели отдают записи прямо из снимка (без копий) — вызывающий их не изменяет.
 
-def get_order(order_id: str) -> Optional[Dict[str, Any]]:
-    ws = get_worksheet("orders")
-    rows = ws.get_all_records()
-    for r in rows:
-        if str(r.get("order_id", "")).strip().lower() == str(order_id).strip().lower():
-            return r
-    return None
+def _find_order(orders: Optional[_Table], order_id: str) -> Optional[Order]:
+    """Заказ по order_id с учётом _MISSING (orders=None — взять снимок из кэша/листа)."""
+    key = _key(order_id)
+    with _LOCK:
+        if key in _MISSING:
+            return None
+    rows = (orders or _table("orders")).find(key)
+    if not rows:
+        with _LOCK:
+            _MISSING[key] = True
+    return rows[0] if rows else None
+
+def get_order(order_id: str) -> Optional[Order]:
+    return _find_order(None, order_id)
+
+# Индекс опечаток строится лениво по снимку orders: новый снимок — новый
+# индекс, заказы, дописанные в тот же снимок, добавляются в готовый.
+_SUGGEST: Dict[str, Any] = {"table": None, "rows": 0, "index": None}
+
+def suggest_order_ids(query: str, limit: int = 3) -> List[str]:
+    """Существующие order_id, похожие на query (опечатка в одном-двух символах).
+
+    Берёт снимок, который уже есть в памяти (даже с истёкшим TTL), —
+    подсказка к «не найдено» не должна сама скачивать лист.
+    """
+    with _LOCK:
+        t = _TABLES.get("orders") or _LAST.get("orders")
+    if t is None:
+        t = _table("orders")
+    with _LOCK:
+        same = _SUGGEST["table"] is t and _SUGGEST["rows"] <= len(t.rows)
+        if same:
+            for r in t.rows[_SUGGEST["rows"]:]:
+                _SUGGEST["index"].add(r.order_id)
+            _SUGGEST["rows"] = len(t.rows)
+            index = _SUGGEST["index"]
+    if not same:
+        rows = list(t.rows)
+        index = OrderIdIndex(r.order_id for r in rows)
+        with _LOCK:
+            _SUGGEST.update(table=t, rows=len(rows), index=index)
+    return index.suggest(query, limit)
+
+def get_order_card(order_id: str, with_subscriptions: bool = False) -> Dict[str, Any]:
+    """Заказ и его участники (и подписчики) за один запрос к таблице.
+
+    Возвращает {"order": Order | None, "participants": [...], ["subscriptions": [...]]};
+    участники — как в get_participants, список заодно кладётся в participants_view.
+    """
+    with _LOCK:
+        missing = _key(order_id) in _MISSING
+    if missing:
+        return {"order": None, "participants": [], **({"subscriptions": []} if with_subscriptions else {})}
+    titles = ["orders", "participants"] + (["subscriptions"] if with_subscriptions else [])
+    orders, parts, *subs = _tables(*titles)
+    order = _find_order(orders, order_id)
+    oid = order.order_id or order_id if order else order_id
+    card: Dict[str, Any] = {"order": order, "participants": _participants_view(parts, oid)}
+    if subs:
+        card["subscriptions"] = subs[0].lookup("order_id", oid)
+    return card
 
 def add_order(order: Dict[str, Any] = None, **kwargs) -> None:
     data = dict(order or {})
@@ -80,81 +866,49 @@ def add_order(order: Dict[str, Any] = None, **kwargs) -> None:
     if not data.get("order_id"):
         raise ValueError("order_id is required")
 
-    ws = get_worksheet("orders")
-    values = ws.get_all_records()
-    df = pd.DataFrame(values)
-    if not df.empty:
-        df = _ensure_orders_cols(df)
-
     now = _now()
-    if df.empty:
-        df = pd.DataFrame([{
-            "order_id": data.get("order_id"),
-            "client_name": data.get("client_name", ""),
-            "phone": data.get("phone", ""),
-            "origin": data.get("origin", ""),
-            "status": data.get("status", ""),
-            "note": data.get("note", ""),
-            "country": data.get("country", ""),
-            "updated_at": now,
-        }])
-    else:
-        mask = df["order_id"].astype(str).str.lower() == str(data.get("order_id")).lower()
-        if mask.any():
-            idx = df.index[mask][0]
-            for k in ["client_name", "phone", "origin", "status", "note", "country"]:
-                if k in data:
-                    df.loc[idx, k] = data.get(k, "")
-            df.loc[idx, "updated_at"] = now
-        else:
-            df.loc[len(df)] = [
-                data.get("order_id"),
-                data.get("client_name", ""),
-                data.get("phone", ""),
-                data.get("origin", ""),
-                data.get("status", ""),
-                data.get("note", ""),
-                data.get("country", ""),
-                now,
-            ]
-
-    ws.clear()
-    ws.append_row(list(df.columns))
-    if len(df):
-        ws.append_rows(df.values.tolist())
+    fields = ["client_name", "phone", "origin", "status", "note", "country"]
+    changes = {k: data.get(k, "") for k in fields if k in data}
+    changes["updated_at"] = now
+    insert = {"order_id": data.get("order_id")}
+    insert.update({k: data.get(k, "") for k in fields})
+    insert["updated_at"] = now
+    _apply("orders", [_Mutation(_key(data.get("order_id")), changes, insert=insert)])
+    with _LOCK:
+        _MISSING.pop(_key(data.get("order_id")), None)
 
 def update_order_status(order_id: str, new_status: str) -> bool:
     """Обновить статус заказа и updated_at. Возвращает True/False (найдена ли запись)."""
-    ws = get_worksheet("orders")
-    values = ws.get_all_records()
-    if not values:
-        return False
-    df = pd.DataFrame(values)
-    df = _ensure_orders_cols(df)
-    mask = df["order_id"].astype(str).str.lower() == str(order_id).lower()
-    if not mask.any():
-        return False
-    df.loc[mask, "status"] = new_status
-    df.loc[mask, "updated_at"] = _now()
-    ws.clear()
-    ws.append_row(list(df.columns))
-    if len(df):
-        ws.append_rows(df.values.tolist())
-    return True
+    changes = {"status": new_status, "updated_at": _now()}
+    return _enqueue("orders", _Mutation(_key(order_id), changes))
+
+def get_order_statuses(fresh: bool = False) -> Dict[str, tuple]:
+    """{order_id в нижнем регистре: (order_id, status, updated_at)} — для поиска изменений."""
+    result: Dict[str, tuple] = {}
+    for r in _table("orders", fresh=fresh).rows:
+        oid = str(r.order_id).strip()
+        if oid:
+            result[oid.lower()] = (oid, str(r.status).strip(), str(r.updated_at).strip())
+    return result
+
+def bulk_update_order_status(order_ids: List[str], new_status: str) -> Dict[str, bool]:
+    """Сменить статус сразу у многих заказов: одно чтение и одна пакетная запись.
+
+    Возвращает {order_id: найден ли заказ} в порядке order_ids.
+    """
+    now = _now()
+    mutations: Dict[tuple, _Mutation] = {}
+    for oid in order_ids:
+        mutations.setdefault(_key(oid), _Mutation(_key(oid), {"status": new_status, "updated_at": now}))
+    results = dict(zip(mutations, _apply("orders", list(mutations.values())))) if mutations else {}
+    return {oid: results[_key(oid)] for oid in order_ids}
 
-def get_orders_by_note(marker: str) -> List[Dict[str, Any]]:
+def get_orders_by_note(marker: str) -> List[Order]:
     """Вернуть все заказы, у которых note содержит подстроку marker (case-insensitive)."""
-    ws = get_worksheet("orders")
-    values = ws.get_all_records()
-    if not values:
-        return []
-    df = pd.DataFrame(values)
-    df = _ensure_orders_cols(df)
     m = str(marker).strip().lower()
     if not m:
         return []
-    subset = df[df["note"].astype(str).str.lower().str.contains(m, na=False)]
-    return subset.to_dict(orient="records")
+    return [r for r in _records("orders") if m in str(r.note).lower()]
 
 def _parse_dt(s: str):
     from datetime import datetime
@@ -164,21 +918,17 @@ def _parse_dt(s: str):
     except Exception:
         return None
 
-def list_recent_orders(limit: int = 20) -> list[dict]:
+def list_recent_orders(limit: int = 20) -> List[Order]:
     """Последние обновлённые заказы по updated_at (desc)."""
-    ws = get_worksheet("orders")
-    values = ws.get_all_records()
-    if not values:
-        return []
-    df = pd.DataFrame(values)
-    df = _ensure_orders_cols(df)
-    # приведём даты и отсортируем
-    df["__dt"] = df["updated_at"].apply(_parse_dt)
-    df = df.sort_values(by="__dt", ascending=False, na_position="last")
-    res = df.drop(columns=["__dt"]).head(limit).to_dict(orient="records")
-    return res
-
-def list_orders_by_status(statuses) -> list[dict]:
+    dated, undated = [], []
+    for r in _records("orders"):
+        dt = _parse_dt(r.updated_at)
+        (dated if dt is not None else undated).append((dt, r))
+    # свежие сверху, заказы без даты — в конце
+    dated.sort(key=lambda x: x[0], reverse=True)
+    return [r for _, r in (dated + undated)[:limit]]
+
+def list_orders_by_status(statuses) -> List[Order]:
     """
     Вернёт заказы по статусу/статусам (без учёта регистра).
     statuses: str | list[str]
@@ -189,26 +939,12 @@ def list_orders_by_status(statuses) -> list[dict]:
     if not wanted:
         return []
 
-    ws = get_worksheet("orders")
-    values = ws.get_all_records()
-    if not values:
-        return []
-    df = pd.DataFrame(values)
-    df = _ensure_orders_cols(df)
-    mask = df["status"].astype(str).str.lower().isin(wanted)
-    return df[mask].to_dict(orient="records")
+    return [r for r in _records("orders") if str(r.status).lower() in wanted]
 
 # -------------------------------------------------
 #  ADDRESSES
 # -------------------------------------------------
 
-def _ensure_addr_cols(df: pd.DataFrame) -> pd.DataFrame:
-    cols = ["user_id", "username", "full_name", "phone", "city", "address", "postcode", "created_at", "updated_at"]
-    for c in cols:
-        if c not in df.columns:
-            df[c] = ""
-    return df[cols]
-
 def upsert_address(
     user_id: int,
     full_name: str,
@@ -218,78 +954,34 @@ def upsert_address(
     postcode: str,
     username: str | None = ""
 ):
-    ws = get_worksheet("addresses")
-    values = ws.get_all_records()
-    df = pd.DataFrame(values)
-    if not df.empty:
-        df = _ensure_addr_cols(df)
-
     now = _now()
     uname = (username or "").lstrip("@").lower()
+    changes = {
+        "username": uname,
+        "full_name": full_name,
+        "phone": phone,
+        "city": city,
+        "address": address,
+        "postcode": postcode,
+        "updated_at": now,
+    }
+    insert = dict(changes, user_id=user_id, created_at=now)
+    _apply("addresses", [_Mutation(_key(user_id), changes, insert=insert)])
 
-    if df.empty:
-        df = pd.DataFrame([{
-            "user_id": user_id,
-            "username": uname,
-            "full_name": full_name,
-            "phone": phone,
-            "city": city,
-            "address": address,
-            "postcode": postcode,
-            "created_at": now,
-            "updated_at": now,
-        }])
-    else:
-        mask = df["user_id"].astype(str) == str(user_id)
-        if mask.any():
-            idx = df.index[mask][0]
-            df.loc[idx, ["username", "full_name", "phone", "city", "address", "postcode", "updated_at"]] = [
-                uname, full_name, phone, city, address, postcode, now
-            ]
-        else:
-            df.loc[len(df)] = [user_id, uname, full_name, phone, city, address, postcode, now, now]
-
-    ws.clear()
-    ws.append_row(list(df.columns))
-    if len(df):
-        ws.append_rows(df.values.tolist())
-
-def list_addresses(user_id: int) -> List[Dict[str, Any]]:
-    ws = get_worksheet("addresses")
-    values = ws.get_all_records()
-    result: List[Dict[str, Any]] = []
-    for r in values:
-        if str(r.get("user_id", "")) == str(user_id):
-            result.append(r)
-    return result
+def list_addresses(user_id: int) -> List[Address]:
+    return _table("addresses").find(_key(user_id))
 
 def delete_address(user_id: int) -> bool:
-    ws = get_worksheet("addresses")
-    values = ws.get_all_records()
-    if not values:
-        return False
-    df = pd.DataFrame(values)
-    if df.empty:
-        return False
-    mask_keep = df["user_id"].astype(str) != str(user_id)
-    if mask_keep.all():
-        return False
-    df = df[mask_keep]
-    ws.clear()
-    ws.append_row(list(df.columns))
-    if len(df):
-        ws.append_rows(df.values.tolist())
-    return True
+    return _apply("addresses", [_Mutation(_key(user_id), delete=True)])[0]
 
-def get_addresses_by_usernames(usernames: List[str]) -> List[Dict[str, Any]]:
-    ws = get_worksheet("addresses")
-    data = ws.get_all_records()
-    by_user = {str((row.get("username") or "").strip().lower()): row for row in data}
+def get_addresses_by_usernames(usernames: List[str]) -> List[Address]:
+    t = _table("addresses")
     result = []
     for u in usernames:
-        row = by_user.get((u or "").strip().lower())
-        if row:
-            result.append(row)
+        rows = t.lookup("username", u or "")
+        if rows:
+            # как и раньше при дублях username — берём последнюю запись
+            result.append(rows[-1])
     return result
 
 def get_user_ids_by_usernames(usernames: List[str]) -> List[int]:
@@ -297,249 +989,191 @@ def get_user_ids_by_usernames(usernames: List[str]) -> List[int]:
     ids: List[int] = []
     for r in rows:
         try:
-            ids.append(int(r.get("user_id")))
+            ids.append(int(r.user_id))
         except Exception:
             pass
     return ids
 
+def get_user_ids_map(usernames: List[str]) -> Dict[str, int]:
+    """{username (без @, в нижнем регистре): user_id} за один проход; ненайденных нет в ответе."""
+    t = _table("addresses")
+    result: Dict[str, int] = {}
+    for u in usernames:
+        uname = (u or "").lstrip("@").strip().lower()
+        rows = t.lookup("username", uname) if uname else []
+        if rows:
+            try:
+                result[uname] = int(rows[-1].user_id)
+            except Exception:
+                pass
+    return result
+
 # -------------------------------------------------
 #  SUBSCRIPTIONS
 # -------------------------------------------------
 
-def _ensure_subs_cols(df: pd.DataFrame) -> pd.DataFrame:
-    cols = ["user_id", "order_id", "last_sent_status", "created_at", "updated_at"]
-    for c in cols:
-        if c not in df.columns:
-            df[c] = ""
-    return df[cols]
-
 def is_subscribed(user_id: int, order_id: str) -> bool:
-    ws = get_worksheet("subscriptions")
-    for r in ws.get_all_records():
-        if str(r.get("user_id", "")) == str(user_id) and str(r.get("order_id", "")).lower() == order_id.lower():
-            return True
-    return False
+    return bool(_table("subscriptions").find(_key(user_id, order_id)))
 
 def subscribe(user_id: int, order_id: str) -> None:
-    ws = get_worksheet("subscriptions")
-    values = ws.get_all_records()
-    df = pd.DataFrame(values)
-    if not df.empty:
-        df = _ensure_subs_cols(df)
-
     now = _now()
-    if df.empty:
-        df = pd.DataFrame([{
-            "user_id": user_id,
-            "order_id": order_id,
-            "last_sent_status": "",
-            "created_at": now,
-            "updated_at": now,
-        }])
-    else:
-        mask = (df["user_id"].astype(str) == str(user_id)) & (df["order_id"].astype(str).str.lower() == order_id.lower())
-        if mask.any():
-            idx = df.index[mask][0]
-            df.loc[idx, "updated_at"] = now
-        else:
-            df.loc[len(df)] = [user_id, order_id, "", now, now]
+    insert = {"user_id": user_id, "order_id": order_id, "last_sent_status": "", "created_at": now, "updated_at": now}
+    _enqueue("subscriptions", _Mutation(_key(user_id, order_id), {"updated_at": now}, insert=insert))
 
-    ws.clear()
-    ws.append_row(list(df.columns))
-    if len(df):
-        ws.append_rows(df.values.tolist())
+def subscribe_many(pairs: List[tuple]) -> None:
+    """Подписать [(user_id, order_id), ...] одной записью в лист."""
+    now = _now()
+    mutations: Dict[tuple, _Mutation] = {}
+    for user_id, order_id in pairs:
+        insert = {"user_id": user_id, "order_id": order_id, "last_sent_status": "", "created_at": now, "updated_at": now}
+        mutations[_key(user_id, order_id)] = _Mutation(_key(user_id, order_id), {"updated_at": now}, insert=insert)
+    if mutations:
+        _apply("subscriptions", list(mutations.values()))
 
 def unsubscribe(user_id: int, order_id: str) -> bool:
-    ws = get_worksheet("subscriptions")
-    values = ws.get_all_records()
-    if not values:
-        return False
-    df = pd.DataFrame(values)
-    mask_keep = ~((df["user_id"].astype(str) == str(user_id)) & (df["order_id"].astype(str).str.lower() == order_id.lower()))
-    if mask_keep.all():
-        return False
-    df = df[mask_keep]
-    ws.clear()
-    ws.append_row(list(df.columns))
-    if len(df):
-        ws.append_rows(df.values.tolist())
-    return True
+    return _apply("subscriptions", [_Mutation(_key(user_id, order_id), delete=True)])[0]
 
-def list_subscriptions(user_id: int) -> List[Dict[str, Any]]:
-    ws = get_worksheet("subscriptions")
-    values = ws.get_all_records()
-    result = []
-    for r in values:
-        if str(r.get("user_id", "")) == str(user_id):
-            result.append(r)
-    return result
+def list_subscriptions(user_id: int) -> List[Subscription]:
+    return _table("subscriptions").lookup("user_id", user_id)
 
-def get_all_subscriptions() -> List[Dict[str, Any]]:
+def get_all_subscriptions() -> List[Subscription]:
     """Вернуть все подписки (для рассылки подписчикам по статусу)."""
-    ws = get_worksheet("subscriptions")
-    return ws.get_all_records()
+    return list(_records("subscriptions"))
+
+def get_subscribers(order_id: str) -> List[Subscription]:
+    """Подписки на конкретный заказ (по индексу order_id)."""
+    return _table("subscriptions").lookup("order_id", order_id)
 
 def set_last_sent_status(user_id: int, order_id: str, status: str) -> None:
     """Обновить last_sent_status у подписки; если нет — создать."""
-    ws = get_worksheet("subscriptions")
-    values = ws.get_all_records()
-    df = pd.DataFrame(values)
-    if not df.empty:
-        df = _ensure_subs_cols(df)
-
     now = _now()
-    if df.empty:
-        df = pd.DataFrame([{
-            "user_id": user_id, "order_id": order_id,
-            "last_sent_status": status, "created_at": now, "updated_at": now
-        }])
-    else:
-        mask = (df["user_id"].astype(str) == str(user_id)) & (df["order_id"].astype(str).str.lower() == order_id.lower())
-        if mask.any():
-            df.loc[mask, "last_sent_status"] = status
-            df.loc[mask, "updated_at"] = now
-        else:
-            df.loc[len(df)] = [user_id, order_id, status, now, now]
+    changes = {"last_sent_status": status, "updated_at": now}
+    insert = {"user_id": user_id, "order_id": order_id, "last_sent_status": status, "created_at": now, "updated_at": now}
+    _enqueue("subscriptions", _Mutation(_key(user_id, order_id), changes, insert=insert))
 
-    ws.clear()
-    ws.append_row(list(df.columns))
-    if len(df):
-        ws.append_rows(df.values.tolist())
+def set_last_sent_statuses(items: List[tuple]) -> None:
+    """set_last_sent_status для [(user_id, order_id, status), ...] одной записью в лист."""
+    now = _now()
+    mutations: Dict[tuple, _Mutation] = {}
+    for user_id, order_id, status in items:
+        changes = {"last_sent_status": status, "updated_at": now}
+        insert = {"user_id": user_id, "order_id": order_id, "last_sent_status": status, "created_at": now, "updated_at": now}
+        mutations[_key(user_id, order_id)] = _Mutation(_key(user_id, order_id), changes, insert=insert)
+    if mutations:
+        _apply("subscriptions", list(mutations.values()))
 
 # -------------------------------------------------
 #  PARTICIPANTS (разборы и оплаты)
 # -------------------------------------------------
 
-def _ensure_part_cols(df: pd.DataFrame) -> pd.DataFrame:
-    cols = ["order_id", "username", "paid", "qty", "created_at", "updated_at"]
-    for c in cols:
-        if c not in df.columns:
-            df[c] = ""
-    return df[cols]
-
 def ensure_participants(order_id: str, usernames: List[str]) -> None:
     """Добавить участников в participants (если их ещё нет), paid=FALSE."""
-    ws = get_worksheet("participants")
-    values = ws.get_all_records()
-    df = pd.DataFrame(values)
-    if not df.empty:
-        df = _ensure_part_cols(df)
-
     now = _now()
-    to_add: List[List[Any]] = []
-    existing = set()
-    if not df.empty:
-        for _, r in df.iterrows():
-            if str(r["order_id"]).lower() == order_id.lower():
-                existing.add(str(r["username"]).strip().lower())
-
+    mutations: List[_Mutation] = []
     for u in usernames:
         uname = (u or "").lstrip("@").strip().lower()
         if not uname:
             continue
-        if uname in existing:
-            continue
-        to_add.append([order_id, uname, "FALSE", "", now, now])
-
-    if to_add:
-        if not values:
-            ws.append_row(["order_id", "username", "paid", "qty", "created_at", "updated_at"])
-        ws.append_rows(to_add)
-
-def get_participants(order_id: str) -> List[Dict[str, Any]]:
-    """Список участников по разбору с полями username/paid/qty."""
-    ws = get_worksheet("participants")
-    data = ws.get_all_records()
-    res: List[Dict[str, Any]] = []
-    for r in data:
-        if str(r.get("order_id", "")).strip().lower() == order_id.strip().lower():
-            res.append({
-                "order_id": r.get("order_id", ""),
-                "username": str(r.get("username", "")).strip().lower(),
-                "paid": str(r.get("paid", "")).strip().lower() in ("true", "1", "yes", "y"),
-                "qty": r.get("qty", ""),
-            })
-    res.sort(key=lambda x: x["username"])
-    return res
+        insert = {"order_id": order_id, "username": uname, "paid": "FALSE", "qty": "", "created_at": now, "updated_at": now}
+        mutations.append(_Mutation(_key(order_id, uname), insert=insert))
+    if mutations:
+        _apply("participants", mutations)
+
+def _participants_view(t: _Table, order_id: str) -> List[Participant]:
+    with _LOCK:
+        view = _VIEWS.get(_norm(order_id))
+        if view is None:
+            view = _participants(_TABLES.get("participants") or t, order_id)
+            _VIEWS[_norm(order_id)] = view
+        return view
+
+def participants_view(order_id: str, fresh: bool = False) -> List[Participant]:
+    """Как get_participants, но из кэша готовых списков: листание без запросов к API.
+
+    fresh=True перечитывает лист (кнопка «Обновить»). Список не изменять.
+    """
+    if fresh:
+        t = _table("participants", fresh=True)  # новый снимок сам сбросит _VIEWS
+        return _participants_view(t, order_id)
+    with _LOCK:
+        view = _VIEWS.get(_norm(order_id))
+    return view if view is not None else _participants_view(_table("participants"), order_id)
+
+def get_participants(order_id: str) -> List[Participant]:
+    """Участники разбора по username (username без @, paid — bool)."""
+    return _participants(_table("participants"), order_id)
+
+def _participants(t: _Table, order_id: str) -> List[Participant]:
+    return sorted(t.lookup("order_id", order_id), key=lambda r: r.username)
 
 def set_participant_paid(order_id: str, username: str, paid: bool) -> bool:
     """Установить paid для username в разборе."""
-    ws = get_worksheet("participants")
-    values = ws.get_all_records()
-    if not values:
-        return False
-    df = pd.DataFrame(values)
-    df = _ensure_part_cols(df)
     uname = (username or "").lstrip("@").lower()
-    mask = (df["order_id"].astype(str).str.lower() == order_id.lower()) & (df["username"].astype(str).str.lower() == uname)
-    if not mask.any():
-        return False
-    df.loc[mask, "paid"] = "TRUE" if paid else "FALSE"
-    df.loc[mask, "updated_at"] = _now()
-    ws.clear()
-    ws.append_row(list(df.columns))
-    if len(df):
-        ws.append_rows(df.values.tolist())
-    return True
+    changes = {"paid": "TRUE" if paid else "FALSE", "updated_at": _now()}
+    return _enqueue("participants", _Mutation(_key(order_id, uname), changes))
+
+# Снаружи всех остальных замков: под ним можно звать _table/_enqueue/_apply.
+_TOGGLE_LOCK = threading.Lock()
 
 def toggle_participant_paid(order_id: str, username: str) -> bool:
     """Инвертировать paid для username; вернуть True, если нашли и обновили."""
-    ws = get_worksheet("participants")
-    values = ws.get_all_records()
-    if not values:
-        return False
-    df = pd.DataFrame(values)
-    df = _ensure_part_cols(df)
     uname = (username or "").lstrip("@").lower()
-    mask = (df["order_id"].astype(str).str.lower() == order_id.lower()) & (df["username"].astype(str).str.lower() == uname)
-    if not mask.any():
-        return False
-    current = str(df.loc[mask, "paid"].iloc[0]).strip().lower() in ("true", "1", "yes", "y")
-    df.loc[mask, "paid"] = "FALSE" if current else "TRUE"
-    df.loc[mask, "updated_at"] = _now()
-    ws.clear()
-    ws.append_row(list(df.columns))
-    if len(df):
-        ws.append_rows(df.values.tolist())
-    return True
+    key = _key(order_id, uname)
+    # чтение текущего значения и запись — под _TOGGLE_LOCK, иначе два быстрых
+    # нажатия увидят одно и то же значение. _LOCK держим только на чтение:
+    # _enqueue/_apply сами берут _JOURNAL_LOCK и _write_lock раньше _LOCK.
+    with _TOGGLE_LOCK:
+        t = _table("participants")
+        with _LOCK:
+            rows = (_TABLES.get("participants") or t).find(key)
+            paid = bool(rows) and rows[0].paid
+        if not rows:
+            return False
+        changes = {"paid": "FALSE" if paid else "TRUE", "updated_at": _now()}
+        return _enqueue("participants", _Mutation(key, changes))
 
 def get_unpaid_usernames(order_id: str) -> List[str]:
-    ws = get_worksheet("participants")
-    data = ws.get_all_records()
     result: List[str] = []
-    for row in data:
-        if str(row.get("order_id", "")).strip().lower() == order_id.strip().lower():
-            paid = str(row.get("paid", "")).strip().lower()
-            if paid not in ("true", "1", "yes", "y"):
-                result.append(str(row.get("username", "")).strip().lower())
+    for row in _table("participants").lookup("order_id", order_id):
+        if not row.paid:
+            result.append(row.username)
     return result
 
 def get_all_unpaid_grouped() -> Dict[str, List[str]]:
-    ws = get_worksheet("participants")
-    data = ws.get_all_records()
     grouped: Dict[str, List[str]] = {}
-    for row in data:
-        order_id = str(row.get("order_id", "")).strip()
-        username = str(row.get("username", "")).strip().lower()
-        paid = str(row.get("paid", "")).strip().lower()
-        if order_id and username and paid not in ("true", "1", "yes", "y"):
-            grouped.setdefault(order_id, []).append(username)
+    for row in _records("participants"):
+        order_id = str(row.order_id).strip()
+        if order_id and row.username and not row.paid:
+            grouped.setdefault(order_id, []).append(row.username)
     return grouped
 
 def find_orders_for_username(username: str) -> List[str]:
     uname = (username or "").lstrip("@").lower()
     if not uname:
         return []
-    ws = get_worksheet("participants")
-    data = ws.get_all_records()
     result: List[str] = []
-    for row in data:
-        if str(row.get("username", "")).strip().lower() == uname:
-            oid = str(row.get("order_id", "")).strip()
-            if oid:
-                result.append(oid)
+    for row in _table("participants").lookup("username", uname):
+        oid = str(row.order_id).strip()
+        if oid:
+            result.append(oid)
     seen = set(); uniq = []
     for x in result:
         if x not in seen:
             uniq.append(x); seen.add(x)
     return uniq
+
+# -------------------------------------------------
+#  USERS (справочник username -> user_id)
+# -------------------------------------------------
+
+def list_users() -> List[User]:
+    return list(_records("users"))
+
+def upsert_users(items: List[tuple]) -> None:
+    """[(user_id, username, last_seen), ...] одной записью в лист users."""
+    mutations: Dict[tuple, _Mutation] = {}
+    for user_id, username, last_seen in items:
+        changes = {"username": username, "last_seen": last_seen}
+        mutations[_key(user_id)] = _Mutation(_key(user_id), changes, insert=dict(changes, user_id=user_id))
+    if mutations:
+        _apply("users", list(mutations.values()))
@@ -0,0 +1,44 @@
+# app/sheets_async.py
+"""Асинхронный фасад над app.sheets.
+
+Вызовы gspread блокирующие, поэтому из хэндлеров они уходят в отдельный
+ограниченный пул потоков: медленный запрос к Google API держит один поток
+пула, а не весь event loop PTB. Любая публичная функция sheets доступна
+здесь с тем же именем и сигнатурой, но как корутина:
+
+    order = await asheets.get_order("CN-12345")
+"""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from . import sheets
+from .config import SHEETS_WORKERS, SHEETS_TIMEOUT
+
+_EXECUTOR = ThreadPoolExecutor(max_workers=SHEETS_WORKERS, thread_name_prefix="sheets")
+
+
+async def run(fn: Callable[..., Any], *args, timeout: Optional[float] = SHEETS_TIMEOUT, **kwargs) -> Any:
+    """Выполнить fn(*args, **kwargs) в пуле sheets, не дольше timeout секунд."""
+    loop = asyncio.get_running_loop()
+    fut = loop.run_in_executor(_EXECUTOR, functools.partial(fn, *args, **kwargs))
+    return await asyncio.wait_for(fut, timeout)
+
+
+def shutdown() -> None:
+    """Остановить пул (ожидающие вызовы отменяются)."""
+    _EXECUTOR.shutdown(wait=False, cancel_futures=True)
+
+
+def __getattr__(name: str):
+    fn = getattr(sheets, name, None)
+    if name.startswith("_") or not callable(fn):
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        return await run(fn, *args, **kwargs)
+
+    globals()[name] = wrapper
+    return wrapper
@@ -0,0 +1,206 @@
+# app/sqlite_store.py
+"""Локальное хранилище листов в SQLite (STORAGE_BACKEND=sqlite).
+
+Каждый лист Google Sheets — отдельная таблица с теми же колонками (всё TEXT)
+плюс служебные:
+  _k       — нормализованный ключ строки (PRIMARY KEY);
+  _dirty   — строка изменена локально и ещё не отправлена в таблицу;
+  _deleted — строка удалена локально (tombstone до синхронизации);
+  _seq     — счётчик изменений строки, чтобы не снять _dirty с правки,
+             пришедшей во время отправки.
+
+Модуль ничего не знает про gspread: sheets.py читает отсюда снимки и
+применяет мутации, а фоновая синхронизация отправляет грязные строки в
+таблицу и забирает обратно правки, сделанные админами руками.
+"""
+import os
+import sqlite3
+import threading
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+_SEP = "\x1f"
+
+# индексы по order_id / user_id / username (в нормализованном виде, как ищет sheets.py);
+# orders.order_id и addresses.user_id — это сам ключ _k
+_INDEXES: Dict[str, List[Tuple[str, str]]] = {
+    "addresses": [("username", "lower(trim(username))")],
+    "subscriptions": [("user_id", "trim(user_id)"), ("order_id", "lower(trim(order_id))")],
+    "participants": [("order_id", "lower(trim(order_id))"), ("username", "lower(trim(username))")],
+    "users": [("username", "lower(trim(username))")],
+}
+
+
+def _q(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+class SqliteStore:
+    def __init__(self, path: str, headers: Dict[str, List[str]], row_key: Callable[[str, Dict[str, Any]], tuple]):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.headers = headers
+        self.row_key = row_key
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._lock:
+            for title, cols in headers.items():
+                defs = ", ".join(f"{_q(c)} TEXT NOT NULL DEFAULT ''" for c in cols)
+                self._db.execute(
+                    f"CREATE TABLE IF NOT EXISTS {_q(title)} (_k TEXT PRIMARY KEY, {defs}, "
+                    "_dirty INTEGER NOT NULL DEFAULT 0, _deleted INTEGER NOT NULL DEFAULT 0, "
+                    "_seq INTEGER NOT NULL DEFAULT 0)"
+                )
+                existing = {r[1] for r in self._db.execute(f"PRAGMA table_info({_q(title)})")}
+                for c in cols:
+                    if c not in existing:
+                        self._db.execute(f"ALTER TABLE {_q(title)} ADD COLUMN {_q(c)} TEXT NOT NULL DEFAULT ''")
+                for name, expr in _INDEXES.get(title, []):
+                    self._db.execute(f"CREATE INDEX IF NOT EXISTS {_q(f'{title}_{name}')} ON {_q(title)} ({expr})")
+                self._db.execute(f"CREATE INDEX IF NOT EXISTS {_q(f'{title}_dirty')} ON {_q(title)} (_dirty)")
+
+    # ---------- чтение ----------
+
+    def values(self, title: str) -> List[List[str]]:
+        """Лист в формате get_all_values(): заголовок + строки (без удалённых)."""
+        cols = self.headers[title]
+        sql = f"SELECT {', '.join(_q(c) for c in cols)} FROM {_q(title)} WHERE _deleted = 0 ORDER BY rowid"
+        with self._lock:
+            rows = self._db.execute(sql).fetchall()
+        return [list(cols)] + [list(r) for r in rows]
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return all(
+                self._db.execute(f"SELECT 1 FROM {_q(t)} LIMIT 1").fetchone() is None for t in self.headers
+            )
+
+    # ---------- запись ----------
+
+    def write(self, title: str, mutations: Sequence[Any]) -> List[bool]:
+        """Применить мутации sheets._Mutation в одной транзакции (семантика как у записи в лист)."""
+        cols = self.headers[title]
+        t = _q(title)
+        results: List[bool] = []
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                for m in mutations:
+                    k = _SEP.join(m.key)
+                    alive = self._db.execute(
+                        f"SELECT 1 FROM {t} WHERE _k = ? AND _deleted = 0", (k,)
+                    ).fetchone() is not None
+                    if m.delete:
+                        if alive:
+                            self._db.execute(
+                                f"UPDATE {t} SET _deleted = 1, _dirty = 1, _seq = _seq + 1 WHERE _k = ?", (k,)
+                            )
+                        results.append(alive)
+                    elif alive:
+                        changes = {c: v for c, v in m.changes.items() if c in cols}
+                        if changes:
+                            sets = ", ".join(f"{_q(c)} = ?" for c in changes)
+                            self._db.execute(
+                                f"UPDATE {t} SET {sets}, _dirty = 1, _seq = _seq + 1 WHERE _k = ?",
+                                [str(v) for v in changes.values()] + [k],
+                            )
+                        results.append(True)
+                    elif m.insert is not None:
+                        row = [str(m.insert.get(c, "")) for c in cols]
+                        names = ", ".join(_q(c) for c in cols)
+                        marks = ", ".join("?" for _ in cols)
+                        updates = ", ".join(f"{_q(c)} = excluded.{_q(c)}" for c in cols)
+                        self._db.execute(
+                            f"INSERT INTO {t} (_k, {names}, _dirty, _deleted, _seq) VALUES (?, {marks}, 1, 0, 1) "
+                            f"ON CONFLICT(_k) DO UPDATE SET {updates}, _dirty = 1, _deleted = 0, _seq = _seq + 1",
+                            [k] + row,
+                        )
+                        results.append(True)
+                    else:
+                        results.append(False)
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return results
+
+    # ---------- синхронизация с таблицей ----------
+
+    def dirty(self, title: str) -> Tuple[List[Tuple[tuple, int, Dict[str, str]]], List[Tuple[tuple, int]]]:
+        """Что отправить в таблицу: ([(ключ, seq, строка)], [(ключ, seq) удалённых])."""
+        cols = self.headers[title]
+        sql = (
+            f"SELECT _k, _seq, _deleted, {', '.join(_q(c) for c in cols)} "
+            f"FROM {_q(title)} WHERE _dirty = 1 ORDER BY rowid"
+        )
+        upserts, deletes = [], []
+        with self._lock:
+            for k, seq, deleted, *vals in self._db.execute(sql):
+                key = tuple(k.split(_SEP))
+                if deleted:
+                    deletes.append((key, seq))
+                else:
+                    upserts.append((key, seq, dict(zip(cols, vals))))
+        return upserts, deletes
+
+    def mark_synced(self, title: str, synced: Sequence[Tuple[tuple, int]]) -> None:
+        """Снять _dirty (и стереть tombstone), если строка не менялась с момента отправки."""
+        t = _q(title)
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                for key, seq in synced:
+                    k = _SEP.join(key)
+                    self._db.execute(f"DELETE FROM {t} WHERE _k = ? AND _seq = ? AND _deleted = 1", (k, seq))
+                    self._db.execute(f"UPDATE {t} SET _dirty = 0 WHERE _k = ? AND _seq = ?", (k, seq))
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def merge_remote(self, title: str, values: List[List[str]]) -> int:
+        """Влить содержимое листа: правки админов побеждают только незагрязнённые строки.
+
+        Возвращает число изменённых локальных строк.
+        """
+        cols = self.headers[title]
+        t = _q(title)
+        header = [str(h).strip() for h in values[0]] if values else []
+        remote: Dict[str, List[str]] = {}
+        for raw in values[1:]:
+            row = dict(zip(header, list(raw) + [""] * (len(header) - len(raw))))
+            key = self.row_key(title, row)
+            if any(key):
+                remote[_SEP.join(key)] = [str(row.get(c, "")) for c in cols]
+
+        changed = 0
+        names = ", ".join(_q(c) for c in cols)
+        with self._lock:
+            local = {
+                k: (dirty, deleted, list(vals))
+                for k, dirty, deleted, *vals in self._db.execute(f"SELECT _k, _dirty, _deleted, {names} FROM {t}")
+            }
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                for k, row in remote.items():
+                    if k not in local:
+                        marks = ", ".join("?" for _ in cols)
+                        self._db.execute(f"INSERT INTO {t} (_k, {names}) VALUES (?, {marks})", [k] + row)
+                        changed += 1
+                        continue
+                    dirty, deleted, vals = local[k]
+                    if dirty or deleted or vals == row:
+                        continue
+                    sets = ", ".join(f"{_q(c)} = ?" for c in cols)
+                    self._db.execute(f"UPDATE {t} SET {sets} WHERE _k = ?", row + [k])
+                    changed += 1
+                for k, (dirty, deleted, _) in local.items():
+                    if k not in remote and not dirty and not deleted:
+                        # строку удалили в таблице руками
+                        self._db.execute(f"DELETE FROM {t} WHERE _k = ?", (k,))
+                        changed += 1
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return changed
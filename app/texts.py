@@ -4,4 +4,9 @@ HELP = (
     "• Отследить заказ — введите номер и получите статус\n"
     "• Мои адреса — добавить/изменить/удалить\n"
     "• Мои подписки — управление уведомлениями по заказам\n"
-)
\ No newline at end of file
+)
+UNPAID_REMINDER = (
+    "💳 Напоминание по разбору *{order_id}*\n"
+    "Статус: *Доставка не оплачена*\n\n"
+    "Пожалуйста, оплатите доставку. Если уже оплатили — можно игнорировать."
+)
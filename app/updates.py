@@ -0,0 +1,106 @@
+# app/updates.py
+"""Очередь входящих апдейтов для вебхука.
+
+/telegram только кладёт апдейт в очередь и сразу отвечает 200, а обработку
+ведут N воркеров. Апдейты одного чата всегда попадают к одному воркеру,
+поэтому порядок сообщений внутри чата сохраняется, а медленный чат не
+задерживает остальные. Повторы от Telegram отсекаются по update_id.
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Dict, List, Optional
+
+from cachetools import TTLCache
+from telegram import Update
+from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateQueue:
+    def __init__(self, application: Application, workers: int, maxsize: int):
+        self.application = application
+        n = max(1, workers)
+        # общий лимит делится между воркерами
+        self._queues: List[asyncio.Queue] = [asyncio.Queue(maxsize=max(1, maxsize // n)) for _ in range(n)]
+        self._tasks: List[asyncio.Task] = []
+        self._seen: TTLCache = TTLCache(maxsize=10000, ttl=3600)
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.duplicates = 0
+        self.last_lag = 0.0
+
+    def start(self) -> None:
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker(q)) for q in self._queues]
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """Дождаться разбора очереди (не дольше timeout) и остановить воркеров."""
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self._queues)), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Update queue not drained in %ss, %s updates dropped", timeout, self.depth())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, update: Update) -> bool:
+        """Поставить апдейт в очередь. False — очередь чата переполнена."""
+        if update.update_id in self._seen:
+            self.duplicates += 1
+            return True
+        q = self._queues[hash(_route(update)) % len(self._queues)]
+        try:
+            q.put_nowait((time.monotonic(), update))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+        self._seen[update.update_id] = True
+        return True
+
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    def lag(self) -> float:
+        """Сколько секунд ждёт самый старый апдейт в очереди."""
+        now = time.monotonic()
+        # заглядываем в голову asyncio.Queue без извлечения
+        heads = [q._queue[0][0] for q in self._queues if q.qsize()]  # type: ignore[attr-defined]
+        return round(now - min(heads), 3) if heads else 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "depth": self.depth(),
+            "lag": self.lag(),
+            "last_lag": round(self.last_lag, 3),
+            "workers": len(self._tasks),
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "duplicates": self.duplicates,
+        }
+
+    async def _worker(self, q: asyncio.Queue) -> None:
+        while True:
+            queued_at, update = await q.get()
+            self.last_lag = time.monotonic() - queued_at
+            try:
+                await self.application.process_update(update)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.exception("Error processing update %s: %s", update.update_id, e)
+            finally:
+                q.task_done()
+
+
+def _route(update: Update) -> Optional[int]:
+    """Ключ упорядочивания: чат, иначе пользователь, иначе сам апдейт."""
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return update.update_id
@@ -8,7 +8,12 @@ from fastapi.responses import Response
 from telegram import Update
 from telegram.ext import Application, ApplicationBuilder
 
+from . import broadcast, directory, poller, sheets, sheets_async
+from .config import UPDATE_WORKERS, UPDATE_QUEUE_SIZE, PERSISTENCE_PATH, PERSISTENCE_SECONDS
+from .digest import DIGEST
 from .main import register_handlers
+from .persistence import SqlitePersistence
+from .updates import UpdateQueue
 try:
     from .main import register_admin_ui
 except Exception:
@@ -19,6 +24,7 @@ logging.basicConfig(level=logging.INFO)
 
 app = FastAPI()
 application: Application | None = None
+updates: UpdateQueue | None = None
 
 
 def _get_bot_token() -> str:
@@ -53,7 +59,11 @@ async def _build_application() -> Application:
     bot_token = _get_bot_token()
     public_url = _get_public_url()
 
-    app_ = ApplicationBuilder().token(bot_token).build()
+    builder = ApplicationBuilder().token(bot_token)
+    # шаги мастеров (user_data) переживают рестарт; PERSISTENCE_PATH= — отключить
+    if PERSISTENCE_PATH:
+        builder = builder.persistence(SqlitePersistence(PERSISTENCE_PATH, PERSISTENCE_SECONDS))
+    app_ = builder.build()
 
     # базовые хэндлеры
     register_handlers(app_)
@@ -66,6 +76,11 @@ async def _build_application() -> Application:
         except Exception as e:
             logger.warning("Admin UI not registered: %s", e)
 
+    # опрос таблицы: статусы, изменённые вручную, тоже доходят до подписчиков
+    poller.schedule(app_)
+    # справочник username -> user_id: локальная база и лист users
+    directory.schedule(app_)
+
     # вебхук
     if public_url:
         url = f"{public_url.rstrip('/')}/telegram"
@@ -79,7 +94,7 @@ async def _build_application() -> Application:
 
 async def _ensure_ready():
     """Гарантирует, что Application создано, initialize()/start() вызваны."""
-    global application
+    global application, updates
     if application is None:
         application = await _build_application()
 
@@ -94,26 +109,71 @@ async def _ensure_ready():
     except Exception:
         # если уже запущено — ок
         pass
+    if updates is None:
+        updates = UpdateQueue(application, UPDATE_WORKERS, UPDATE_QUEUE_SIZE)
+        updates.start()
 
 
 @app.on_event("startup")
 async def on_startup():
-    global application
+    global application, updates
+    # вернуть в очередь записи в таблицу, не подтверждённые до рестарта
+    try:
+        n = await sheets_async.replay_journal()
+        if n:
+            logger.info("Replayed %s pending sheet writes from journal.", n)
+    except Exception as e:
+        logger.exception("Failed to replay sheets journal: %s", e)
+    # SQLite-режим: первичная загрузка из таблицы и фоновое зеркалирование
+    try:
+        await sheets_async.run(sheets.start_sync, timeout=None)
+    except Exception as e:
+        logger.exception("Failed to start sqlite <-> sheets sync: %s", e)
+    try:
+        n = await sheets_async.run(directory.DIRECTORY.load, timeout=None)
+        logger.info("User directory loaded: %s users.", n)
+    except Exception as e:
+        logger.exception("Failed to load user directory: %s", e)
     application = await _build_application()
     # ВАЖНО: инициализация и старт
     await application.initialize()
     await application.start()
+    updates = UpdateQueue(application, UPDATE_WORKERS, UPDATE_QUEUE_SIZE)
+    updates.start()
+    # рассылка, прерванная рестартом, продолжается с сохранённого курсора
+    try:
+        await broadcast.resume_on_startup(application)
+    except Exception as e:
+        logger.exception("Failed to resume broadcast: %s", e)
     logger.info("Startup complete: application initialized & started.")
 
 
 @app.on_event("shutdown")
 async def on_shutdown():
-    # Корректное завершение
+    # Корректное завершение: сначала разобрать уже принятые апдейты
+    if updates is not None:
+        await updates.stop()
+    # накопленные сводки уведомлений — отправить, пока бот ещё жив
+    try:
+        await DIGEST.flush()
+    except Exception as e:
+        logger.exception("Failed to flush notification digests: %s", e)
     if application is not None:
         try:
             await application.stop()
         finally:
             await application.shutdown()
+    try:
+        await sheets_async.run(directory.DIRECTORY.sync)
+    except Exception as e:
+        logger.exception("Failed to sync user directory: %s", e)
+    # отложенные записи в таблицу не должны пропасть при рестарте
+    try:
+        n = await sheets_async.flush()
+        logger.info("Flushed %s pending sheet writes.", n)
+    except Exception as e:
+        logger.exception("Failed to flush pending sheet writes: %s", e)
+    sheets_async.shutdown()
     logger.info("Shutdown complete.")
 
 
@@ -121,27 +181,37 @@ async def on_shutdown():
 async def telegram(request: Request):
     await _ensure_ready()
 
-    data = await request.json()
     try:
+        data = await request.json()
         update = Update.de_json(data, application.bot)
-        # диагностика
-        try:
-            utype = (
-                "message" if getattr(update, "message", None) else
-                "callback_query" if getattr(update, "callback_query", None) else
-                "other"
-            )
-            logger.info("[webhook] incoming update: type=%s", utype)
-        except Exception:
-            pass
-
-        await application.process_update(update)
     except Exception as e:
-        logger.exception("Error processing update: %s", e)
+        logger.warning("Bad update payload: %s", e)
+        return Response(status_code=400)
+    if update is None:
+        return Response(status_code=400)
+
+    # диагностика
+    try:
+        utype = (
+            "message" if getattr(update, "message", None) else
+            "callback_query" if getattr(update, "callback_query", None) else
+            "other"
+        )
+        logger.info("[webhook] incoming update: type=%s", utype)
+    except Exception:
+        pass
 
+    # не держим запрос Telegram открытым на время обработки: только в очередь
+    if not updates.submit(update):
+        # очередь переполнена — пусть Telegram повторит доставку позже
+        logger.warning("Update queue full, rejecting update %s", update.update_id)
+        return Response(status_code=503)
     return Response(status_code=200)
 
 
 @app.get("/health")
 async def health():
-    return {"ok": True}
+    # глубина и задержка очереди апдейтов — для мониторинга
+    if updates is None:
+        return {"ok": True}
+    return {"ok": True, "updates": updates.stats()}
@@ -0,0 +1,142 @@
+"""Задержка ответа бота: прежние sleep-паузы против индикатора по таймеру.
+
+Запуск из корня репозитория:  python bench/reply_latency.py
+
+Бот и таблица подменяются заглушками: каждый вызов Telegram API стоит
+TG_RTT, чтение из таблицы — от 0 (снимок в кэше) до 0.8 с (скачивание
+листа). Замер — от начала обработки апдейта до отправленного ответа,
+как в логе [latency]. «До» — копия прежних хелперов (send_chat_action +
+sleep 0.6 перед каждым ответом и ещё 0.4–0.5 в query_status /
+show_subscriptions), «после» — текущие функции из app.main.
+"""
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import main  # noqa: E402
+from app import sheets_async as asheets  # noqa: E402
+
+TG_RTT = 0.05
+FETCH = (0.0, 0.2, 0.8)
+RUNS = 5
+
+
+class _Bot:
+    def __init__(self):
+        self.actions = 0
+
+    async def send_chat_action(self, **kwargs):
+        self.actions += 1
+        await asyncio.sleep(TG_RTT)
+
+
+class _Message:
+    chat_id = 1
+
+    async def reply_text(self, text, **kwargs):
+        await asyncio.sleep(TG_RTT)
+
+    async def reply_markdown(self, text, **kwargs):
+        await asyncio.sleep(TG_RTT)
+
+
+class _Update:
+    _ids = iter(range(1, 10**9))
+
+    def __init__(self):
+        self.update_id = next(self._ids)
+        self.message = _Message()
+        self.callback_query = None
+        # новый пользователь на каждый прогон — не упираться в LOOKUP_BURST
+        self.effective_user = type("User", (), {"id": 10**6 + self.update_id, "username": None, "is_bot": False})()
+        self.effective_chat = type("Chat", (), {"id": 1})()
+
+
+class _Context:
+    def __init__(self):
+        self.bot = _Bot()
+        self.user_data = {}
+        self.application = None
+
+
+def _stub_sheets(fetch: float) -> None:
+    async def get_order(order_id):
+        await asyncio.sleep(fetch)
+        return {"order_id": order_id, "status": "🛒 выкуплен", "origin": "CN"}
+
+    async def is_subscribed(user_id, order_id):
+        return False
+
+    async def list_subscriptions(user_id):
+        await asyncio.sleep(fetch)
+        return [{"order_id": "CN-1001", "last_sent_status": "🛒 выкуплен"}]
+
+    asheets.get_order = get_order
+    asheets.is_subscribed = is_subscribed
+    asheets.list_subscriptions = list_subscriptions
+
+
+# ---------- прежние хелперы (для сравнения) ----------
+
+async def _legacy_typing(context, chat_id, seconds=0.6):
+    try:
+        await context.bot.send_chat_action(chat_id=chat_id, action="typing")
+    except Exception:
+        pass
+    await asyncio.sleep(seconds)
+
+
+async def _legacy_reply(update, context, text):
+    await _legacy_typing(context, update.message.chat_id)
+    await update.message.reply_text(text)
+
+
+async def _legacy_query_status(update, context, order_id):
+    await _legacy_typing(context, update.effective_chat.id, 0.5)
+    await asheets.get_order(order_id)
+    await asheets.is_subscribed(update.effective_user.id, order_id)
+    await _legacy_typing(context, update.message.chat_id)
+    await update.message.reply_markdown("...")
+
+
+async def _legacy_show_subscriptions(update, context):
+    await _legacy_typing(context, update.effective_chat.id, 0.4)
+    await asheets.list_subscriptions(update.effective_user.id)
+    await _legacy_reply(update, context, "...")
+
+
+CASES = [
+    ("plain reply", lambda u, c: _legacy_reply(u, c, "..."), lambda u, c: main.reply_animated(u, c, "...")),
+    ("query_status", lambda u, c: _legacy_query_status(u, c, "CN-1001"), lambda u, c: main.query_status(u, c, "CN-1001")),
+    ("show_subscriptions", _legacy_show_subscriptions, main.show_subscriptions),
+]
+
+
+async def _ms(handler) -> tuple:
+    times, actions = [], 0
+    for _ in range(RUNS):
+        update, context = _Update(), _Context()
+        started = time.perf_counter()
+        await handler(update, context)
+        times.append((time.perf_counter() - started) * 1000)
+        actions += context.bot.actions
+    return statistics.median(times), actions / RUNS
+
+
+async def run() -> None:
+    print(f"Telegram RTT {TG_RTT * 1000:.0f} ms, TYPING_DELAY {main.TYPING_DELAY:.1f} s, median of {RUNS}")
+    for fetch in FETCH:
+        _stub_sheets(fetch)
+        for name, before, after in CASES:
+            old_ms, old_actions = await _ms(before)
+            new_ms, new_actions = await _ms(after)
+            print(f"fetch {fetch * 1000:4.0f} ms | {name:<18} | before: {old_ms:6.0f} ms ({old_actions:.0f} typing) "
+                  f"| after: {new_ms:6.0f} ms ({new_actions:.0f} typing)")
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
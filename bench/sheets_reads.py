@@ -0,0 +1,142 @@
+"""Время импорта sheets.py и выборок по orders без pandas.
+
+Запуск из корня репозитория:  python bench/sheets_reads.py
+
+Импорт меряется в отдельном процессе (как холодный старт контейнера).
+Разбор снимка: время и память _Table на записях со __slots__ против
+прежних строк-словарей (dict(zip(header, row)) на каждую строку).
+Выборки get_orders_by_note / list_recent_orders / list_orders_by_status
+идут по in-memory листу; если pandas установлен, для сравнения печатается
+время прежней реализации через DataFrame. suggest — подсказки к опечатке
+в номере: сборка индекса по снимку и один запрос к готовому индексу.
+"""
+import gc
+import os
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from app import sheets  # noqa: E402
+from app.order_index import OrderIdIndex  # noqa: E402
+
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+
+def import_ms(stmt: str, runs: int = 5) -> float:
+    code = f"import time; t = time.perf_counter(); {stmt}; print((time.perf_counter() - t) * 1000)"
+    times = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True)
+        times.append(float(out.stdout.strip()))
+    return statistics.median(times)
+
+
+class _Worksheet:
+    def __init__(self, values):
+        self.values = values
+
+    def get_all_values(self):
+        return [list(r) for r in self.values]
+
+
+class _Spreadsheet:
+    def get_lastUpdateTime(self):
+        return "bench"
+
+
+def _legacy(values):
+    """Прежние выборки через pandas (для сравнения)."""
+    df = pd.DataFrame(values)
+    df_note = df[df["note"].astype(str).str.lower().str.contains("admin1", na=False)].to_dict(orient="records")
+    df2 = pd.DataFrame(values)
+    df2["__dt"] = df2["updated_at"].apply(sheets._parse_dt)
+    recent = df2.sort_values(by="__dt", ascending=False, na_position="last").drop(columns=["__dt"]).head(20)
+    recent = recent.to_dict(orient="records")
+    df3 = pd.DataFrame(values)
+    by_status = df3[df3["status"].astype(str).str.lower().isin({"🛒 выкуплен"})].to_dict(orient="records")
+    return df_note, recent, by_status
+
+
+def _current():
+    return (
+        sheets.get_orders_by_note("admin1"),
+        sheets.list_recent_orders(20),
+        sheets.list_orders_by_status("🛒 выкуплен"),
+    )
+
+
+def per_call_ms(fn, repeat: int = 5) -> float:
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - started) * 1000)
+    return statistics.median(times)
+
+
+def _measure(fn):
+    gc.collect()
+    elapsed = per_call_ms(fn)
+    tracemalloc.start()
+    kept = fn()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return elapsed, size / 1024 / 1024
+
+
+def snapshot(values) -> str:
+    """Только строки снимка, без индексов _Table."""
+    header = values[0]
+    read = sheets.RECORDS["orders"].reader(header)
+    ms, mb = _measure(lambda: [read(raw) for raw in values[1:]])
+    old_ms, old_mb = _measure(lambda: [dict(zip(header, raw)) for raw in values[1:]])
+    return f"rows: {ms:5.1f} ms {mb:5.1f} MB (dicts: {old_ms:5.1f} ms {old_mb:5.1f} MB)"
+
+
+def suggest(values) -> str:
+    ids = [raw[0] for raw in values[1:]]
+    build = per_call_ms(lambda: OrderIdIndex(ids), repeat=3)
+    index = OrderIdIndex(ids)
+    queries = ["CN-1234", "cn 1oo7", "CN-99999x", "CN-21", "KR-55"] * 200
+    started = time.perf_counter()
+    for q in queries:
+        index.suggest(q)
+    per_query = (time.perf_counter() - started) / len(queries) * 1_000_000
+    return f"suggest: build {build:6.1f} ms, query {per_query:5.1f} µs"
+
+
+def run(size: int) -> None:
+    header = sheets.HEADERS["orders"]
+    values = [list(header)] + [
+        [f"CN-{i}", f"client{i}", "", "CN", "🛒 выкуплен" if i % 3 else "🚚 отправлен по Казахстану",
+         f"admin{i % 7}", "KZ", f"2025-01-{1 + i % 28:02d}T00:00:00"]
+        for i in range(size)
+    ]
+    sheets.get_worksheet = lambda title: _Worksheet(values)
+    sheets._sheet = lambda: _Spreadsheet()
+    sheets.invalidate_cache()
+    sheets._table("orders")  # снимок в кэше — меряем только выборки
+
+    line = f"{size:>7} orders | {snapshot(values)} | plain lists: {per_call_ms(_current):7.1f} ms"
+    line += f" | {suggest(values)}"
+    if pd is not None:
+        records = [r.to_dict() for r in sheets._records("orders")]
+        line += f" | pandas (before): {per_call_ms(lambda: _legacy(records)):7.1f} ms"
+    print(line)
+
+
+if __name__ == "__main__":
+    print(f"import app.sheets: {import_ms('import app.sheets'):.0f} ms")
+    if pd is not None:
+        print(f"import pandas:     {import_ms('import pandas'):.0f} ms (больше не платим на старте)")
+    for n in (1_000, 10_000, 50_000):
+        run(n)
@@ -0,0 +1,84 @@
+"""Размер записи в Google Sheets при росте листа.
+
+Запуск из корня репозитория:  python bench/sheets_writes.py
+
+Лист participants подменяется in-memory заглушкой, которая считает запросы и
+записанные ячейки. Для сравнения печатается, сколько ячеек переписывал бы
+старый путь clear() + append_row(header) + append_rows(вся таблица).
+Запись идёт сразу (SHEETS_WRITE_DELAY=0), иначе отметка оплаты только
+встаёт в очередь write-behind и запросов не видно. Журнал отложенных записей
+выключен: фейковые изменения не должны попасть в data/ и уйти в живую
+таблицу при следующем старте бота.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["SHEETS_WRITE_DELAY"] = "0"  # до импорта app.config
+os.environ["SHEETS_JOURNAL_PATH"] = ""
+
+from gspread.utils import a1_range_to_grid_range  # noqa: E402
+
+from app import sheets  # noqa: E402
+
+
+class _Worksheet:
+    def __init__(self, title, values):
+        self.title = title
+        self.values = values
+        self.requests = 0
+        self.cells = 0
+
+    def get_all_values(self):
+        return [list(r) for r in self.values]
+
+    def append_rows(self, rows, **kwargs):
+        self.requests += 1
+        self.cells += sum(len(r) for r in rows)
+        self.values.extend([list(map(str, r)) for r in rows])
+
+    def delete_rows(self, start, end=None):
+        self.requests += 1
+        del self.values[start - 1:(end or start)]
+
+
+class _Spreadsheet:
+    def __init__(self, ws):
+        self.ws = ws
+
+    def get_lastUpdateTime(self):
+        return str(self.ws.requests)
+
+    def values_batch_update(self, body=None):
+        self.ws.requests += 1
+        for d in body["data"]:
+            grid = a1_range_to_grid_range(d["range"].rsplit("!", 1)[1])
+            row = self.ws.values[grid["startRowIndex"]]
+            for j, v in enumerate(d["values"][0]):
+                row[grid["startColumnIndex"] + j] = str(v)
+                self.ws.cells += 1
+
+
+def run(size: int) -> None:
+    header = sheets.HEADERS["participants"]
+    values = [list(header)] + [
+        [f"CN-{i // 10}", f"user{i}", "FALSE", "", "2025-01-01T00:00:00", "2025-01-01T00:00:00"]
+        for i in range(size)
+    ]
+    ws = _Worksheet("participants", values)
+    sheets.get_worksheet = lambda title: ws
+    sheets._sheet = lambda: _Spreadsheet(ws)
+    sheets.invalidate_cache()
+
+    started = time.perf_counter()
+    sheets.toggle_participant_paid(f"CN-{(size - 1) // 10}", f"user{size - 1}")
+    elapsed = (time.perf_counter() - started) * 1000
+    legacy = (size + 1) * len(header)
+    print(f"{size:>7} rows | requests: {ws.requests} | cells written: {ws.cells:>3} "
+          f"| legacy rewrite: {legacy:>7} cells | {elapsed:6.1f} ms")
+
+
+if __name__ == "__main__":
+    for n in (100, 1_000, 10_000, 50_000):
+        run(n)